@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# RuntimeContext allocations and gc collections while highlighting, with and without reuse of popped contexts
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import hl
+from hl import (
+	Grammar,
+	RuntimeContext,
+	SyntaxHighlighter,
+)
+from sublsyntax import (
+	loadsyntax,
+	parsesyntax,
+	syntax_dir_path,
+	file_ext as sublsynt_ext,
+)
+
+
+class CountingContext(RuntimeContext):
+
+	__slots__ = ()
+	created = 0
+
+	def __new__(cls, *args):
+		CountingContext.created += 1
+		return super().__new__(cls)
+
+
+def highlight(grammar:Grammar, lines:list):
+	events = []
+	shl = SyntaxHighlighter(grammar, events)
+	shl.begin()
+	for line in lines:
+		shl.process(line)
+		events.clear()
+	shl.end()
+
+
+def dictsize(obj):
+	return sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, "__dict__") else 0)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-s", "--syntax", type=str, help="sublime-syntax to use", default="C++")
+	parser.add_argument("input_file", type=str, help="input file")
+	args = parser.parse_args()
+	syntax = parsesyntax(loadsyntax(os.path.join(syntax_dir_path, f"{args.syntax}.{sublsynt_ext}")))
+	with open(args.input_file, "r", encoding="utf-8", errors="replace") as f:
+		lines = f.readlines()
+	grammar = Grammar(syntax)
+	# compile every context the input needs before measuring
+	highlight(grammar, lines)
+	# the same object with a __dict__, as before __slots__
+	DictContext = type("DictContext", (), {"__init__": RuntimeContext.__init__})
+	ctx_args = (syntax, "main", (), False, None, None)
+	print(f"RuntimeContext size: {dictsize(RuntimeContext(*ctx_args))} bytes, with a __dict__: {dictsize(DictContext(*ctx_args))} bytes")
+	print(f"{len(lines)} lines")
+	print(f"{'':<12} {'seconds':>8} {'contexts':>10} {'gc gen0':>8} {'gc gen1':>8} {'gc gen2':>8} {'peak KiB':>9}")
+	free_max = hl.max_free_contexts
+	for name, max_free in (("no reuse", 0), ("free list", free_max)):
+		hl.max_free_contexts = max_free
+		gc.collect()
+		t0 = perf_counter()
+		highlight(grammar, lines)
+		elapsed = perf_counter() - t0
+		hl.RuntimeContext = CountingContext
+		CountingContext.created = 0
+		gc.collect()
+		collections = [s["collections"] for s in gc.get_stats()]
+		tracemalloc.start()
+		highlight(grammar, lines)
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		collections = [s["collections"] - c for s, c in zip(gc.get_stats(), collections)]
+		hl.RuntimeContext = RuntimeContext
+		print(f"{name:<12} {elapsed:>8.2f} {CountingContext.created:>10} {collections[0]:>8} {collections[1]:>8} {collections[2]:>8} {peak / 1024:>9.0f}")
+	hl.max_free_contexts = free_max
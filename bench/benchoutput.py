@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# writes per line and time per line of the output path, tokenization excluded
+
+import argparse
+import io
+import os
+import sys
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from hl import (
+	Grammar,
+	SyntaxHighlighter,
+)
+from hlio import FlushingWriter
+from hlrender import AnsiRenderer
+from sublcolorscheme import (
+	loadparsedcolorscheme,
+	color_scheme_dir_path,
+	file_ext as sublcolscheme_ext,
+)
+from sublsyntax import (
+	loadsyntax,
+	parsesyntax,
+	syntax_dir_path,
+	file_ext as sublsynt_ext,
+)
+
+
+class CountingSink(io.RawIOBase):
+
+	# binary sink that only counts what it's given
+
+	def __init__(self):
+		self.writes = 0
+		self.bytes = 0
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		self.writes += 1
+		self.bytes += len(data)
+		return len(data)
+
+
+class CountingWriter:
+
+	def __init__(self, out):
+		self.out = out
+		self.writes = 0
+
+	def write(self, s:str):
+		self.writes += 1
+		self.out.write(s)
+
+
+def tokenize(syntax:dict, path:str):
+	lines = []
+	events = []
+	shl = SyntaxHighlighter(Grammar(syntax), events)
+	shl.begin()
+	with open(path, "r", encoding="utf-8", errors="replace") as f:
+		for line in f:
+			shl.process(line)
+			lines.append(tuple(events))
+			events.clear()
+	shl.end()
+	lines.append(tuple(events))
+	return lines
+
+
+def pertoken(lines:list, renderer:AnsiRenderer):
+	# every token and color change written on its own to a line buffered text stream (stdout on a
+	# terminal), escapes from the renderer's cache as the per-line path gets them
+	sink = CountingSink()
+	out = CountingWriter(io.TextIOWrapper(sink, encoding="utf-8", line_buffering=True))
+	for events in lines:
+		for event in events:
+			if event.__class__ is str:
+				out.write(event)
+			else:
+				out.write(renderer.escape(event))
+	out.out.flush()
+	return out.writes, sink
+
+
+def perline(lines:list, renderer:AnsiRenderer, policy:str):
+	# the events of a line rendered into one string, encoded and written to the binary sink per policy
+	sink = CountingSink()
+	writer = FlushingWriter(sink, policy=policy)
+	out = CountingWriter(writer)
+	for events in lines:
+		renderer.render(events, out)
+		writer.line_done()
+	writer.flush()
+	return out.writes, sink
+
+
+def preencoded(lines:list, renderer:AnsiRenderer):
+	# the events of a line appended to a bytearray, escapes cached already encoded, one write of the
+	# line to the binary sink
+	sink = CountingSink()
+	out = CountingWriter(sink)
+	escapes = {}
+	buf = bytearray()
+	for events in lines:
+		for event in events:
+			if event.__class__ is str:
+				buf += event.encode("utf-8", "replace")
+			else:
+				escape = escapes.get(event, None)
+				if escape is None:
+					escape = escapes[event] = renderer.escape(event).encode("utf-8")
+				buf += escape
+		out.write(bytes(buf))
+		buf.clear()
+	return out.writes, sink
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-s", "--syntax", type=str, help="sublime-syntax to use", default="Python")
+	parser.add_argument("-c", "--color-scheme", type=str, help="sublime-color-scheme to use", default="Mariana")
+	parser.add_argument("-r", "--repeat", type=int, help="runs per variant, the best one is reported", default=5)
+	parser.add_argument("input_file", type=str, help="input file")
+	args = parser.parse_args()
+	syntax = parsesyntax(loadsyntax(os.path.join(syntax_dir_path, f"{args.syntax}.{sublsynt_ext}")))
+	lines = tokenize(syntax, args.input_file)
+	color_scheme = loadparsedcolorscheme(os.path.join(color_scheme_dir_path, f"{args.color_scheme}.{sublcolscheme_ext}"))
+	variants = (
+		("per token, text layer", lambda r:pertoken(lines, r)),
+		("per line, flush line", lambda r:perline(lines, r, "line")),
+		("per line, flush size", lambda r:perline(lines, r, "size")),
+		("per line, pre-encoded", lambda r:preencoded(lines, r)),
+	)
+	n = len(lines)
+	print(f"{n} lines, {sum(map(len, lines)) / n:.1f} events per line")
+	print(f"{'variant':<24} {'writes/line':>12} {'sink writes/line':>17} {'us/line':>9}")
+	for name, run in variants:
+		best = None
+		for i in range(args.repeat):
+			renderer = AnsiRenderer(color_scheme)
+			t0 = perf_counter()
+			writes, sink = run(renderer)
+			elapsed = perf_counter() - t0
+			best = elapsed if best is None else min(best, elapsed)
+		print(f"{name:<24} {writes / n:>12.2f} {sink.writes / n:>17.3f} {best * 1e6 / n:>9.2f}")
@@ -3,29 +3,60 @@
 
 import argparse
 import os
-import onigurumacffi as oniguruma
 import regex as re
 import sys
+import threading
+from collections import (
+	OrderedDict,
+	deque,
+)
+from concurrent.futures import Future
+from copy import copy
 from io import StringIO
-from math import (
-	floor,
-	ceil,
+from itertools import chain
+from time import (
+	perf_counter_ns,
+	thread_time,
+)
+from hlio import (
+	EscapesTee,
+	FlushingWriter,
+	FollowStream,
+	decode_errors,
+	flush_policies,
+	mmapable,
+	mmaplines,
+	readhistory,
+	readlines,
+	tailoffset,
+)
+from hlprofile import Profiler
+import hlrender
+from hlrender import (
+	AnsiRenderer,
+	HtmlRenderer,
+)
+from hlstream import (
+	ScopeStreamReader,
+	ScopeStreamWriter,
+	GrepFilter,
+	LineRange,
+	LineSplitter,
+	linetext,
+	parselinerange,
 )
-from scsast import scorexp
+from scsast import (
+	atomize,
+	scopename,
+)
+from scsvec import scorer_engines
 from sublcolorscheme import (
-	loadcolorscheme,
-	parsecolorscheme,
+	loadparsedcolorscheme,
 	file_ext as sublcolscheme_ext,
 	color_scheme_dir_path,
 	all_color_schemes_names,
 )
-from sublcolorsys import (
-	rgba_to_ansi256,
-	hlsa_to_rgba,
-	rgba_to_hlsa,
-	hlsa_lerp,
-	term_color,
-)
+import sublregex
 from sublsyntax import (
 	loadsyntax,
 	loadsyntaxesmp,
@@ -36,11 +67,46 @@ from sublsyntax import (
 	all_syntaxes_names,
 	all_syntaxes_paths,
 	loadsyntax_until,
+	syntaxpathsbyscope,
+	syntaxreferences,
 )
 
 
+dbg = None
+# RuntimeContexts kept for reuse per SyntaxHighlighter, one per level of the deepest stack is enough
+max_free_contexts = 256
+
+
+def lineended(events:list):
+	# -> whether the text of events ends with a line ending
+	for event in reversed(events):
+		if event.__class__ is str:
+			return event.endswith("\n")
+	return False
+
+
+def group_matched(match, n:int):
+	# onigurumacffi spans of non-participating groups point past the match, don't write them
+	return match._begs[n] >= 0
+
+
 class RuntimeContext:
 
+	__slots__ = (
+		"syntax",
+		"name",
+		"actionlist",
+		"lenactionlist",
+		"curr_action_id",
+		"included",
+		"metascope",
+		"meta_content_scope",
+		"branch_meta",
+		"with_prototype",
+		"embed",
+		"dispatch",
+	)
+
 	def __init__(
 		self,
 		syntax,
@@ -61,6 +127,14 @@ class RuntimeContext:
 		self.branch_meta = None
 		self.with_prototype = with_prototype
 		self.embed = embed
+		self.dispatch = None
+
+	def __copy__(self):
+		# save_state() copies the whole stack for every line, skip the generic __reduce_ex__ path
+		rtctx = RuntimeContext.__new__(RuntimeContext)
+		for name in RuntimeContext.__slots__:
+			setattr(rtctx, name, getattr(self, name))
+		return rtctx
 
 	def __str__(self):
 		return f"{self.name} included: {self.included} metascope: {self.metascope} meta_content_scope: {self.meta_content_scope} branch_meta: {'yes' if self.branch_meta else 'no'} syntax: {self.syntax['name']}"
@@ -68,6 +142,8 @@ class RuntimeContext:
 
 class BranchMetadata:
 
+	__slots__ = ("ctx_id", "branch_point", "branches_iter", "prev_text", "prev_pos", "prev_io")
+
 	def __init__(self, ctx_id, branch_point, branches_iter, prev_text, prev_pos, prev_io):
 		self.ctx_id = ctx_id
 		self.branch_point = branch_point
@@ -90,6 +166,8 @@ class BranchMetadata:
 
 class WithPrototype:
 
+	__slots__ = ("context", "syntax")
+
 	def __init__(self, context, syntax):
 		self.context = context
 		self.syntax = syntax
@@ -97,127 +175,376 @@ class WithPrototype:
 
 class Embed:
 
+	__slots__ = (
+		"escape_pattern",
+		"rollback_id",
+		"content_scope",
+		"captures",
+		"horizon_text",
+		"horizon_from",
+		"horizon",
+		"horizon_match",
+	)
+
 	def __init__(self, escape_pattern, rollback_id, content_scope, captures):
 		self.escape_pattern = escape_pattern
 		self.rollback_id = rollback_id
 		self.content_scope = content_scope
 		self.captures = captures
+		# where the escape matches next in horizon_text, searched from horizon_from
+		self.horizon_text = None
+		self.horizon_from = 0
+		self.horizon = 0
+		self.horizon_match = None
 
+	def escape_match(self, text:str, pos:int):
+		# the escape is searched once per line instead of tried at every position the embedded
+		# syntax restarts from: before the horizon it cannot match, at the horizon it does
+		if text is not self.horizon_text or not self.horizon_from <= pos <= self.horizon:
+			# new line, rolled back, or a token went past the horizon
+			match = self.escape_pattern.search(text, pos)
+			self.horizon_text = text
+			self.horizon_from = pos
+			self.horizon = match.start() if match else len(text)
+			self.horizon_match = match
+		return self.horizon_match if pos == self.horizon else None
 
-class SyntaxHighlighter:
 
-	def __init__(
-		self,
-		syntax:dict,
-		color_scheme:dict,
-		io,
-		show_scopes:bool=False
-	):
-		self.contextstack = []
+class DispatchTable:
+
+	def __init__(self, firsts:list):
+		# per action: None if it must always be tried, False if it never does anything,
+		# else (ascii chars, non-ascii) its match can start with
+		self.firsts = firsts
+		self.nexts = {}
+
+	def candidates(self, c:str):
+		# for each action id, the id of the first action from there on that can match at c
+		nexts = self.nexts.get(c, None)
+		if nexts is None:
+			key = c if c.isascii() else None
+			nexts = self.nexts.get(key, None)
+			if nexts is None:
+				firsts = self.firsts
+				n = len(firsts)
+				nexts = [n] * (n + 1)
+				for i in range(n - 1, -1, -1):
+					f = firsts[i]
+					if f is None or (f and (key in f[0] if key is not None else f[1])):
+						nexts[i] = i
+					else:
+						nexts[i] = nexts[i + 1]
+				nexts = self.nexts[key] = tuple(nexts)
+			self.nexts[c] = nexts
+		return nexts
+
+
+class Grammar:
+
+	# compiled syntaxes, shared by any number of SyntaxHighlighters, also across threads: the loaded
+	# yaml is never modified, every context is compiled once (under the lock) into actions that are
+	# only read afterwards, all the state of a run lives in its SyntaxHighlighter
+
+	re_varsub = re.compile(r"{{([A-Za-z0-9_]+)}}")
+	re_backref = re.compile(r"\\(?:([0-9])|.)", re.DOTALL)
+	escapes_size = 1024
+
+	def __init__(self, syntax:dict):
 		self.main_syntax = syntax
 		self.syntaxes_by_scope = {}
-		self.color_scheme = color_scheme
-		self.io = io
-		self.scopestack = []
-		self.scopepops = []
-		self.show_scopes = show_scopes
+		self.contexts = {}
+		self.escapes = {}
+		# path -> Future of the syntax, whichever thread asks first loads it, the others wait
+		self.loading = {}
+		self.lock = threading.RLock()
 		self.cache_scope_to_syntax_map(syntax)
-		
+
 	def load_syntax_lazy(self, path : str):
-		return parsesyntax(
-			loadsyntax(path),
-			self.cache_scope_to_syntax_map
-		)
+		with self.lock:
+			future = self.loading.get(path, None)
+			owner = future is None
+			if owner:
+				future = self.loading[path] = Future()
+		if owner:
+			try:
+				syntax = parsesyntax(
+					loadsyntax(path),
+					self.cache_scope_to_syntax_map
+				)
+				# already parsed by another grammar
+				self.cache_scope_to_syntax_map(syntax)
+				future.set_result(syntax)
+			except BaseException as e:
+				future.set_exception(e)
+		return future.result()
 
 	def cache_scope_to_syntax_map(self, syntax):
 		self.syntaxes_by_scope[syntax["scope"]] = syntax
 
 	def load_syntax_lazy_with_scope(self, syntax_scope : str):
-		if syntax_scope in self.syntaxes_by_scope:
-			return self.syntaxes_by_scope[syntax_scope]
-		scope_regex = re.compile(fr"^scope:[ ]*{syntax_scope}", re.IGNORECASE)
-		for path in all_syntaxes_paths:
-			with open(path, "r", encoding="latin1") as f:
-				for line in f:
-					if scope_regex.match(line):
-						return self.load_syntax_lazy(path)
-
-	token_color_cache = {}
-
-	def token_color(self, token:str):
-		scopestack = self.scopestack
-		cache_key = hash((*(y for x in scopestack for y in x), token))
-		if cache_key in self.token_color_cache:
-			if dbg: dbg(f"token_color: token: {repr(token)} cached: {self.token_color_cache[cache_key]}")
-			return self.token_color_cache[cache_key]
-		_globals = self.color_scheme["globals"]
-		rules = self.color_scheme["rules"]
-		best = None
-		best_score = 0
-		lenss = len(scopestack)
-		if dbg: dbg(f"token_color: token: {repr(token)} ss: {scopestack}")
-		for rule in rules:
-			xp = rule["scope"]
-			score = scorexp(
-				xp,
-				scopestack,
-				lenss
+		syntax = self.syntaxes_by_scope.get(syntax_scope, None)
+		if syntax is not None:
+			return syntax
+		path = syntaxpathsbyscope().get(syntax_scope, None)
+		if path is None:
+			return None
+		return self.load_syntax_lazy(path)
+
+	def reference_path(self, ref:str):
+		# path of the syntax a scope: or packages/ reference points to
+		if ref.startswith("scope:"):
+			return syntaxpathsbyscope().get(ref[len("scope:"):].partition("#")[0], None)
+		return os.path.abspath(
+			os.path.join(
+				syntax_dir_path,
+				os.path.basename(ref)
 			)
-			if score > 0 and (best is None or score > best_score):
-				best = rule
-				best_score = score
-		if best is not None:
-			foreground = best.get("foreground", _globals["foreground"])
-			if dbg: dbg(f"token_color: token: {repr(token)} best rule: {best} has gradient: {'yes' if isinstance(foreground, list) else 'no'}")
-			if isinstance(foreground, list):
-				color_t = hash(token) % 255 / 255 if token else 0.0
-				samp_t = color_t * len(foreground) - color_t
-				foreground = hlsa_to_rgba(
-					*hlsa_lerp(
-						rgba_to_hlsa(*foreground[int(floor(samp_t))]),
-						rgba_to_hlsa(*foreground[int(ceil(samp_t))]),
-						color_t
-					)
-				)
-				if dbg: dbg(f"token_color: token: {repr(token)} color_t: {color_t} samp_t: {samp_t} color: {foreground}")
-			entry = (
-				rgba_to_ansi256(*foreground),
-				rgba_to_ansi256(*best.get("background", _globals["background"]))
+		)
+
+	def prefetch(self):
+		# load and compile every syntax the main one can reach in the background, so that
+		# the first <script> of an html file doesn't stall the output
+		thread = threading.Thread(target=self.prefetchall, name="prefetch", daemon=True)
+		thread.start()
+		return thread
+
+	def prefetchall(self):
+		seen = set()
+		queue = deque((self.main_syntax,))
+		while queue:
+			for ref in sorted(syntaxreferences(queue.popleft())):
+				path = self.reference_path(ref)
+				if path is None or path in seen:
+					continue
+				seen.add(path)
+				try:
+					syntax = self.load_syntax_lazy(path)
+					for ctx in syntax["contexts"].values():
+						self.context(syntax, ctx)
+				except Exception:
+					# push_context reports it, if the reference is ever followed
+					continue
+				queue.append(syntax)
+
+	def expand_pattern(self, patt, syntax:dict):
+		while True:
+			varnames = self.re_varsub.findall(patt)
+			if not varnames:
+				break
+			for varname in varnames:
+				var = syntax["variables"].get(varname, None)
+				if var:
+					patt = patt.replace(f"{{{{{varname}}}}}", var, 1)
+				else:
+					raise KeyError(f"variable: {varname} not found")
+		return patt
+
+	def hasbackrefs(self, patt:str):
+		return any(map(lambda m:m.group(1) is not None, self.re_backref.finditer(patt)))
+
+	def compile_pattern(self, patt, syntax:dict, groups:tuple=None):
+		# if dbg: dbg(f"compiling pattern: {patt}")
+		opatt = patt
+		patt = self.expand_pattern(patt, syntax)
+		if groups is not None:
+			# backreferences to the groups of another match, as literal text
+			patt = self.re_backref.sub(
+				lambda m:sublregex.escape(groups[int(m.group(1))]) if m.group(1) is not None and int(m.group(1)) < len(groups) else m.group(),
+				patt
 			)
-			self.token_color_cache[cache_key] = entry
-			return entry
-		else:
-			if dbg: dbg(f"no matching rule for token: {repr(token)}")
-		entry = rgba_to_ansi256(*_globals["foreground"]), rgba_to_ansi256(*_globals["background"])
-		self.token_color_cache[cache_key] = entry
+		try:
+			# patterns made from match text are as many as the texts, don't keep them for the process
+			return sublregex.compile(patt, intern=groups is None)
+		except Exception:
+			print(f"errors compiling pattern: {opatt} => {patt}", file=sys.stderr)
+			raise
+
+	def context(self, syntax:dict, ctx:list):
+		# -> (compiled actions, dispatch table) of a context of syntax; the same context gets compiled
+		# once per syntax using it, an extending syntax may give its variables other values
+		key = (id(syntax), id(ctx))
+		entry = self.contexts.get(key, None)
+		if entry is None:
+			with self.lock:
+				entry = self.contexts.get(key, None)
+				if entry is None:
+					compiled = list(map(lambda x:self.compile_action(x, syntax), ctx))
+					# keep references to syntax and ctx, their ids mustn't be reused
+					entry = self.contexts[key] = (
+						syntax,
+						ctx,
+						tuple(map(lambda x:x[0], compiled)),
+						DispatchTable(list(map(lambda x:x[1], compiled)))
+					)
+		return entry[2], entry[3]
+
+	def embed_escape(self, escape:str, syntax:dict, match):
+		# an escape with backreferences, compiled once per distinct text of the groups it refers to
+		groups = tuple(map(lambda n:match.group(n) if group_matched(match, n) else "", range(len(match._begs))))
+		key = (id(syntax), escape, groups)
+		patt = self.escapes.get(key, None)
+		if patt is None:
+			patt = self.compile_pattern(escape, syntax, groups)
+			with self.lock:
+				if len(self.escapes) >= self.escapes_size:
+					del self.escapes[next(iter(self.escapes))]
+				# syntax is also kept by self.contexts, its id isn't reused
+				self.escapes[key] = patt
+		return patt
+
+	def compile_action(self, actiondef, syntax:dict):
+		# -> (copy of actiondef with its patterns compiled, first chars it can match, see DispatchTable)
+		if not isinstance(actiondef, dict) or not actiondef:
+			return actiondef, None
+		action = next(iter(actiondef))
+		if action == "include":
+			return actiondef, None
+		if action != "match":
+			return actiondef, False
+		compiled = dict(actiondef)
+		escape = compiled.get("escape", None)
+		if isinstance(escape, str) and not self.hasbackrefs(escape):
+			# escapes with backreferences are compiled once the match they refer to is known
+			try:
+				compiled["escape"] = sublregex.compile(self.expand_pattern(escape, syntax))
+			except Exception:
+				pass
+		try:
+			patt = sublregex.compile(self.expand_pattern(compiled["match"], syntax))
+		except Exception:
+			# left for action_match to report when it's tried
+			return compiled, None
+		patt.pattern = patt
+		compiled["match"] = patt
+		return compiled, sublregex.firstchars(patt._pattern)
+
+
+class LineCache:
+
+	def __init__(self, max_bytes:int):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	@property
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.0
+
+	def get(self, key):
+		entry = self.entries.get(key, None)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.entries.move_to_end(key)
 		return entry
 
+	def put(self, key, events:tuple, state):
+		entry_size = len(key[1]) + 64 * len(events) + 128 * len(state[0])
+		if entry_size > self.max_bytes:
+			return
+		self.entries[key] = (events, state, entry_size)
+		self.size += entry_size
+		while self.size > self.max_bytes:
+			_, (_, _, evicted_size) = self.entries.popitem(last=False)
+			self.size -= evicted_size
+			self.evictions += 1
+
+	def __str__(self):
+		return f"line cache: hits: {self.hits} misses: {self.misses} hit rate: {self.hit_rate:.2%} entries: {len(self.entries)} size: {self.size} evictions: {self.evictions}"
+
+
+class SyntaxHighlighter:
+
+	def __init__(
+		self,
+		syntax:dict,
+		io:list,
+		show_scopes:bool=False,
+		profiler:Profiler=None,
+		line_cache:LineCache=None,
+		line_max_bytes:int=0,
+		line_max_time:float=0.0
+	):
+		self.contextstack = []
+		# popped RuntimeContexts, reused by push_context()
+		self.free_contexts = []
+		self.grammar = syntax if isinstance(syntax, Grammar) else Grammar(syntax)
+		self.main_syntax = self.grammar.main_syntax
+		self.io = io
+		self.scopestack = ()
+		self.scopepops = []
+		self.show_scopes = show_scopes
+		self.profiler = profiler
+		self.line_cache = line_cache
+		self.line_max_bytes = line_max_bytes
+		self.line_max_time = line_max_time
+		self.degraded_lines = 0
+
+	def write_color(self, token:str=None):
+		# renderers pick the color for (scopestack, token)
+		self.io.append((self.scopestack, token))
+
 	def push_scope(self, scopes:str):
 		scopes = scopes.split(" ")
 		self.scopepops.append(len(scopes))
 		for scope in scopes:
-			self.scopestack.append(scope.split("."))
-			token_color = self.token_color(None)
-			if dbg: dbg(f"push_scope: {scope} color: {token_color}")
-			self.io.write(term_color(*token_color))
+			self.scopestack += (atomize(scope),)
+			if dbg: dbg(f"push_scope: {scope}")
+			self.write_color()
 			if self.show_scopes:
-				self.io.write(f"<{scope}>")
+				self.io.append(f"<{scope}>")
 		
 	def pop_scope(self):
 		npops = self.scopepops.pop()
 		for i in range(npops):
-			rtscope = self.scopestack.pop()
+			rtscope = self.scopestack[-1]
+			self.scopestack = self.scopestack[:-1]
 			if self.show_scopes:
-				self.io.write(f"</{'.'.join(rtscope)}>")
-			token_color = self.token_color(None)
-			if dbg: dbg(f"pop_scope: {rtscope} color: {token_color}")
-			self.io.write(term_color(*token_color))
+				self.io.append(f"</{scopename(rtscope)}>")
+			if dbg: dbg(f"pop_scope: {scopename(rtscope)}")
+			self.write_color()
 
 	def write_token(self, token:str):
-		token_color = self.token_color(token)
-		if dbg: dbg(f"write_token: {repr(token)} color: {token_color}")
-		self.io.write(term_color(*token_color))
-		self.io.write(token)
+		if dbg: dbg(f"write_token: {repr(token)}")
+		self.write_color(token)
+		self.io.append(token)
+
+	def write_captures(self, match, captures:dict, text:str, mbegin:int, mend:int):
+		# groups are either disjoint or nested: sort them by position and keep the enclosing ones open
+		spans = []
+		for capidx, gscope in captures.items():
+			if group_matched(match, capidx):
+				gmbegin, gmend = match.span(capidx)
+				if mbegin <= gmbegin and gmend <= mend:
+					spans.append((gmbegin, gmend, gscope))
+		spans.sort(key=lambda x:(x[0], -x[1]))
+		openends = []
+		for gmbegin, gmend, gscope in spans:
+			while openends and openends[-1] <= gmbegin:
+				gend = openends.pop()
+				if mbegin < gend:
+					self.write_token(text[mbegin:gend])
+					mbegin = gend
+				self.pop_scope()
+			if mbegin < gmbegin:
+				self.write_token(text[mbegin:gmbegin])
+				mbegin = gmbegin
+			if gmbegin < gmend:
+				self.push_scope(gscope)
+				openends.append(gmend)
+		while openends:
+			gend = openends.pop()
+			if mbegin < gend:
+				self.write_token(text[mbegin:gend])
+				mbegin = gend
+			self.pop_scope()
+		if mbegin < mend:
+			self.write_token(text[mbegin:mend])
 
 	@property
 	def context(self):
@@ -264,15 +591,12 @@ class SyntaxHighlighter:
 				extscope, key = pushref.groups()
 				if not key:
 					key = "main"
-				syntax = self.load_syntax_lazy_with_scope(extscope)
+				syntax = self.grammar.load_syntax_lazy_with_scope(extscope)
 				if not syntax:
 					raise KeyError(f"push_context: external syntax (by scope): {extscope} not found, are you missing a syntax file?")
 			elif key.startswith("packages/"): #hacky
-				mapped_path = os.path.join(
-					syntax_dir_path,
-					os.path.basename(key)
-				)
-				syntax = self.load_syntax_lazy(mapped_path)
+				mapped_path = self.grammar.reference_path(key)
+				syntax = self.grammar.load_syntax_lazy(mapped_path)
 				if not syntax:
 					raise KeyError(f"push_context: external syntax: '{mapped_path}' not found, are you missing a syntax file?")
 				key = "main"
@@ -282,7 +606,13 @@ class SyntaxHighlighter:
 				with_prototype = self.contextstack[-1].with_prototype if self.contextstack else None
 			if embed is None:
 				embed = self.contextstack[-1].embed if self.contextstack else None
-			rtctx = RuntimeContext(syntax, key, ctx, included, with_prototype, embed)
+			actionlist, dispatch = self.grammar.context(syntax, ctx)
+			if self.free_contexts:
+				rtctx = self.free_contexts.pop()
+				rtctx.__init__(syntax, key, actionlist, included, with_prototype, embed)
+			else:
+				rtctx = RuntimeContext(syntax, key, actionlist, included, with_prototype, embed)
+			rtctx.dispatch = dispatch
 			if not included:
 				clear_scopes = ctx_findprop(ctx, "clear_scopes", None)
 				if clear_scopes:
@@ -313,6 +643,7 @@ class SyntaxHighlighter:
 					self.push_scope(meta_content_scope)
 			# if dbg: dbg(f"push_context: {rtctx}")
 			self.contextstack.append(rtctx)
+			if self.profiler: self.profiler.push(rtctx)
 			if dbg: dbg("push:" + " <- ".join(map(lambda x:f"{x.name}{'(inc)' if x.included else ''}{'(branch)' if x.branch_meta else ''}{'(embed)' if x.embed else ''}({x.syntax['name']})", reversed(self.contextstack))))
 			if not included and key != "prototype":
 				self.reset_context(rtctx)
@@ -322,6 +653,7 @@ class SyntaxHighlighter:
 	def pop_context(self, handle_branching=True):
 		if dbg: dbg("pop:" + " <- ".join(map(lambda x:f"{x.name}{'(inc)' if x.included else ''}{'(branch)' if x.branch_meta else ''}{'(embed)' if x.embed else ''}({x.syntax['name']})", reversed(self.contextstack))))
 		rtctx = self.contextstack.pop()
+		if self.profiler: self.profiler.pop(rtctx)
 		# if dbg: dbg(f"pop_context: {rtctx}")
 		if not rtctx.included:
 			if rtctx.meta_content_scope:
@@ -335,12 +667,12 @@ class SyntaxHighlighter:
 			if nextctx.branch_meta:
 				if dbg: dbg(f"BRANCH success: branch: {rtctx.name} of {nextctx.branch_meta.branch_point} @ {nextctx.name}")
 				prev_io = nextctx.branch_meta.prev_io
-				prev_io.write(self.io.getvalue())
-				self.io.close()
+				prev_io.extend(self.io)
 				self.io = prev_io
 				nextctx.branch_meta = None
 		assert rtctx.branch_meta == None
-		return rtctx
+		if len(self.free_contexts) < max_free_contexts:
+			self.free_contexts.append(rtctx)
 
 	def reset_context(self, rtctx):
 		if rtctx.included:
@@ -354,26 +686,8 @@ class SyntaxHighlighter:
 			if not any(map(lambda x:not x.get("meta_include_prototype", True), rtctx.actionlist)):
 				self.push_context("prototype", included=True)
 
-	re_varsub = re.compile(r"{{([A-Za-z0-9_]+)}}")
-
 	def compile_pattern(self, patt, rtctx):
-		# if dbg: dbg(f"compiling pattern: {patt}")
-		opatt = patt
-		while True:
-			varnames = self.re_varsub.findall(patt)
-			if not varnames:
-				break
-			for varname in varnames:
-				var = rtctx.syntax["variables"].get(varname, None)
-				if var:
-					patt = patt.replace(f"{{{{{varname}}}}}", var, 1)
-				else:
-					raise KeyError(f"variable: {varname} not found")
-		try:
-			return oniguruma.compile(patt)
-		except Exception:
-			print(f"errors compiling pattern: {opatt} => {patt}")
-			raise
+		return self.grammar.compile_pattern(patt, rtctx.syntax)
 
 	def begin(self):
 		assert len(self.contextstack) == 0
@@ -384,23 +698,130 @@ class SyntaxHighlighter:
 		if scope:
 			self.push_scope(scope)
 
+	def state_key(self):
+		key = []
+		for ctx in self.contextstack:
+			if ctx.branch_meta:
+				return None
+			with_prototype = ctx.with_prototype
+			embed = ctx.embed
+			key.append((
+				id(ctx.syntax),
+				id(ctx.actionlist),
+				ctx.curr_action_id,
+				ctx.included,
+				ctx.metascope,
+				ctx.meta_content_scope,
+				(id(with_prototype.context), id(with_prototype.syntax)) if with_prototype else None,
+				(embed.escape_pattern, embed.rollback_id, embed.content_scope, id(embed.captures)) if embed else None,
+			))
+		return (
+			tuple(key),
+			self.scopestack,
+			tuple(self.scopepops),
+		)
+
+	def save_state(self):
+		return (
+			tuple(map(copy, self.contextstack)),
+			self.scopestack,
+			tuple(self.scopepops),
+		)
+
+	def restore_state(self, state):
+		contextstack, scopestack, scopepops = state
+		self.contextstack = list(map(copy, contextstack))
+		self.scopestack = scopestack
+		self.scopepops = list(scopepops)
+
 	def process(self, text:str, pos:int=0):
+		line_max_bytes = self.line_max_bytes
+		if line_max_bytes and len(text) - pos > line_max_bytes // 4:
+			if len(text[pos:].encode("utf-8", "replace")) > line_max_bytes:
+				self.degrade_line(text, pos)
+				return text
+		line_cache = self.line_cache
+		if line_cache is None or pos != 0:
+			return self.analyze(text, pos)
+		key = self.state_key()
+		if key is None:
+			return self.analyze(text, pos)
+		key = (key, text)
+		entry = line_cache.get(key)
+		if entry is not None:
+			events, state, _ = entry
+			self.io.extend(events)
+			self.restore_state(state)
+			return text
+		io = self.io
+		captured = self.io = []
+		degraded_lines = self.degraded_lines
+		text = self.analyze(text, pos)
+		if self.io is captured:
+			self.io = io
+		for ctx in self.contextstack:
+			if ctx.branch_meta:
+				# branch still pending: redirect its rollback output to the real stream
+				if ctx.branch_meta.prev_io is captured:
+					ctx.branch_meta.prev_io = io
+				break
+		else:
+			if degraded_lines == self.degraded_lines:
+				line_cache.put(key, tuple(captured), self.save_state())
+		io.extend(captured)
+		return text
+
+	def degrade_line(self, text:str, pos:int, state=None):
+		if dbg: dbg(f"DEGRADE pos: {pos} text: {repr(text[pos:pos + 8])}...")
+		# over budget: settle pending branches as they are, write the rest of the line with default colors
+		for ctx in reversed(self.contextstack):
+			if ctx.branch_meta:
+				prev_io = ctx.branch_meta.prev_io
+				prev_io.extend(self.io)
+				self.io = prev_io
+				ctx.branch_meta = None
+		# the empty scope stack gets the color scheme defaults
+		self.io.append(((), None))
+		self.io.append(text[pos:])
+		if state is not None:
+			# and carry on from the state the line started with
+			self.restore_state(state)
+			for ctx in self.contextstack:
+				ctx.branch_meta = None
+		self.write_color()
+		self.degraded_lines += 1
+
+	def analyze(self, text:str, pos:int=0):
 		if dbg: dbg(f"init ANALYZE pos: {pos} text: {repr(text[pos:pos + 8])}...")
 		for ctx in self.contextstack:
 			if ctx.branch_meta:
 				ctx.branch_meta.prev_text.write(text)
+		if self.line_max_time:
+			deadline = thread_time() + self.line_max_time
+			start_state = self.save_state()
+			steps = 0
+		else:
+			deadline = None
 		while pos < len(text):
+			if deadline is not None:
+				steps += 1
+				if not steps & 255 and thread_time() > deadline:
+					self.degrade_line(text, pos, start_state)
+					return text
 			rtctx = self.contextstack[-1]
 			rtctx_curr_action_id = rtctx.curr_action_id
 			if rtctx_curr_action_id == 0 and rtctx.embed:
 				didRollback, text, pos = self.match_embed_and_rollback(rtctx, text, pos)
 				if didRollback:
 					continue
+			if rtctx_curr_action_id < rtctx.lenactionlist:
+				# skip the actions that cannot match at text[pos]
+				rtctx_curr_action_id = rtctx.dispatch.candidates(text[pos])[rtctx_curr_action_id]
 			if rtctx_curr_action_id >= rtctx.lenactionlist:
 				if rtctx.included:
 					self.pop_context()
 					continue
-				self.io.write(text[pos])
+				self.io.append(text[pos])
 				pos += 1
 				self.reset_context(rtctx)
 				if dbg and pos < len(text): dbg(f"loop ANALYZE pos: {pos} text: {repr(text[pos:pos + 8])}...")
@@ -424,11 +845,21 @@ class SyntaxHighlighter:
 	def action_match(self, rtctx, text:str, pos:int, actiondef:dict):
 		patt = actiondef["match"]
 		if isinstance(patt, str):
-			pattern = patt
+			# the grammar couldn't compile it, this reports why
 			patt = self.compile_pattern(patt, rtctx)
 			patt.pattern = patt
-			actiondef["match"] = patt
-		match = patt.match(text, pos)
+		prof = self.profiler
+		if prof:
+			if prof.timing:
+				t0 = perf_counter_ns()
+				match = patt.match(text, pos)
+				elapsed_ns = perf_counter_ns() - t0
+			else:
+				match = patt.match(text, pos)
+				elapsed_ns = 0
+			prof.match(rtctx, rtctx.curr_action_id - 1, actiondef, match is not None, elapsed_ns)
+		else:
+			match = patt.match(text, pos)
 		if match:
 			scope = actiondef.get("scope", None)
 			captures = actiondef.get("captures", None)
@@ -449,18 +880,9 @@ class SyntaxHighlighter:
 					embed_escape = actiondef["escape"]
 				except KeyError:
 					raise KeyError(f"embed_escape is required when specifying and embed. ctx: {rtctx}")
-				try:
-					gi = 0
-					while True:
-						#fix-me: syntax-blind replace, but at least it works in usual cases
-						if match.group(gi):
-							embed_escape = re.sub(f"(?<=\\b)\\\\{gi}(?=\\b)", match.group(gi), embed_escape)
-						gi += 1
-				except IndexError:
-					pass
 				if isinstance(embed_escape, str):
-					embed_escape = self.compile_pattern(embed_escape, rtctx)
-					actiondef["escape"] = embed_escape
+					# it refers to this match
+					embed_escape = self.grammar.embed_escape(embed_escape, rtctx.syntax, match)
 				try:
 					revid, itm = next(filter(lambda x:not x[1].included, enumerate(reversed(self.contextstack))))
 					rollback_id = len(self.contextstack) - revid - 1
@@ -487,18 +909,7 @@ class SyntaxHighlighter:
 				if scope:
 					self.push_scope(scope)
 				if captures:
-					for capidx, gscope in captures.items():
-						gmbegin, gmend = match.span(capidx)
-						if mbegin < gmbegin:
-							self.write_token(text[mbegin:gmbegin])
-							mbegin = gmbegin
-						if gmbegin < gmend:
-							self.push_scope(gscope)
-							self.write_token(match.group(capidx))
-							self.pop_scope()
-							mbegin = gmend
-					if mbegin < pos:
-						self.write_token(text[mbegin:pos])
+					self.write_captures(match, captures, text, mbegin, pos)
 				else:
 					self.write_token(match.group())
 				if scope:
@@ -533,7 +944,7 @@ class SyntaxHighlighter:
 					pos,
 					self.io
 				)
-				self.io = StringIO()
+				self.io = []
 				next_branch_name = next(branch_ctx.branch_meta.branches_iter)
 				if dbg: dbg(f"BRANCH init from: {branch_point} @ {branch_ctx.name} (pos: {pos} text: {repr(text[pos:pos+8])}...) to: {next_branch_name}")
 				self.push_context(next_branch_name, with_prototype=with_prototype)
@@ -545,14 +956,13 @@ class SyntaxHighlighter:
 					for ipop in range(pops):
 						self.pop_context(handle_branching=False)
 					pos, text, prev_io = rollback_ctx.branch_meta.rollback()
-					self.io.close()
-					self.io = StringIO()
+					if prof: prof.branch_rollbacks += 1
+					self.io = []
 					try:
 						next_branch_name = next(rollback_ctx.branch_meta.branches_iter)
 						if dbg: dbg(f"BRANCH next from: {fail} @ {rollback_ctx.name} to: {next_branch_name}")
 						self.push_context(next_branch_name, with_prototype=with_prototype)
 					except StopIteration:
-						self.io.close()
 						self.io = prev_io
 						rollback_ctx.branch_meta = None
 				except StopIteration:
@@ -570,7 +980,7 @@ class SyntaxHighlighter:
 		return pos, text
 
 	def match_embed_and_rollback(self, rtctx, text, pos):
-		match = rtctx.embed.escape_pattern.match(text, pos)
+		match = rtctx.embed.escape_match(text, pos)
 		if match:
 			pops = len(self.contextstack) - rtctx.embed.rollback_id
 			if dbg: dbg(f"EMBED: match: {match} pos: {pos} text: {repr(text[pos:pos+8])}... rollback pops: {pops}")
@@ -578,18 +988,7 @@ class SyntaxHighlighter:
 			if rtctx.embed.content_scope:
 				self.pop_scope()
 			if rtctx.embed.captures:
-				for capidx, gscope in rtctx.embed.captures.items():
-					gmbegin, gmend = match.span(capidx)
-					if mbegin < gmbegin:
-						self.write_token(text[mbegin:gmbegin])
-						mbegin = gmbegin
-					if gmbegin < gmend:
-						self.push_scope(gscope)
-						self.write_token(match.group(capidx))
-						self.pop_scope()
-						mbegin = gmend
-				if mbegin < pos:
-					self.write_token(text[mbegin:pos])
+				self.write_captures(match, rtctx.embed.captures, text, mbegin, pos)
 			else:
 				self.write_token(match.group())
 			for ipop in range(pops):
@@ -599,22 +998,316 @@ class SyntaxHighlighter:
 		return False, text, pos
 
 
+class IncrementalHighlighter:
+
+	# keeps the events of every line of a buffer and the engine state at every line start, so that
+	# an edit is re-highlighted from the first line it touches until the state converges again
+
+	def __init__(self, syntax, **kwargs):
+		self.shl = SyntaxHighlighter(syntax, [], **kwargs)
+		self.lines = []
+		# per line: events, state_key() and save_state() at its start (None while a branch is pending,
+		# and for line 0 which starts with begin()); one more of each for the end of the buffer
+		self.events = []
+		self.keys = [None]
+		self.states = [None]
+		# events of end() after the last line ending
+		self.tail = []
+
+	def set_text(self, lines:list):
+		return self.edit(0, len(self.lines), lines)
+
+	def edit(self, start:int, stop:int, lines:list):
+		# replaces lines [start, stop) (with their line endings) -> [(line number, events)] of the lines
+		# whose events changed, numbered after the edit
+		if not 0 <= start <= stop <= len(self.lines):
+			raise IndexError(f"edit: invalid line range: {start}:{stop} of {len(self.lines)} lines")
+		shl = self.shl
+		old_events, old_keys, old_states = self.events, self.keys, self.states
+		delta = len(lines) - (stop - start)
+		edit_end = start + len(lines)
+		self.lines = self.lines[:start] + list(lines) + self.lines[stop:]
+		# restart from the closest line start with a saved state
+		restart = start
+		while restart > 0 and old_states[restart] is None:
+			restart -= 1
+		events = old_events[:restart]
+		keys = old_keys[:restart]
+		states = old_states[:restart]
+		if restart:
+			shl.restore_state(old_states[restart])
+		else:
+			shl.contextstack = []
+			shl.scopestack = ()
+			shl.scopepops = []
+		# events go to lines by their newlines, a pending branch hands out those of several lines at once
+		out = []
+		shl.io = out
+		splitter = LineSplitter()
+		converged = None
+		for i in range(restart, len(self.lines)):
+			key = shl.state_key()
+			# old line 0 has the events of begin()
+			if i > restart and i >= edit_end and i - delta and key is not None and key == old_keys[i - delta]:
+				converged = i
+				break
+			if not i:
+				shl.begin()
+				key = shl.state_key()
+			keys.append(key)
+			states.append(shl.save_state() if key is not None and i else None)
+			shl.process(self.lines[i])
+			events.extend(splitter.split(out))
+			out.clear()
+			if shl.state_key() is not None:
+				# nothing held back, color changes after the line ending are still this line's
+				rest = splitter.end()
+				if len(events) == i:
+					# the last line, without a line ending
+					events.append(rest)
+				elif rest:
+					events[-1].extend(rest)
+		if converged is not None:
+			events.extend(old_events[converged - delta:])
+			keys.extend(old_keys[converged - delta:])
+			states.extend(old_states[converged - delta:])
+			end = converged
+		else:
+			key = shl.state_key()
+			keys.append(key)
+			states.append(shl.save_state() if key is not None and self.lines else None)
+			if not self.lines:
+				shl.begin()
+			shl.end()
+			events.extend(splitter.split(out))
+			self.tail = splitter.end()
+			if len(events) < len(self.lines):
+				# the last line, without a line ending, was waiting for a branch
+				events.append(self.tail)
+				self.tail = []
+			end = len(self.lines)
+		self.events, self.keys, self.states = events, keys, states
+		changed = []
+		for i in range(restart, end):
+			if start <= i < edit_end:
+				changed.append((i, events[i]))
+				continue
+			j = i if i < start else i - delta
+			if events[i] != old_events[j]:
+				changed.append((i, events[i]))
+		return changed
+
+
+def resyncstate(grammar:Grammar, lines:list, whole:bool, window:int=256, **kwargs):
+	# -> save_state() after lines, the last ones before some point of an input (all of them if whole).
+	# The input is highlighted from main at two line starts window lines apart: once both reach
+	# the same state, what came before doesn't matter anymore. Without convergence the window
+	# doubles, up to all of lines, which is exact only if whole
+	n = len(lines)
+	while True:
+		a = max(0, n - 2 * window)
+		b = max(a, n - window) if a or not whole else n
+		first = SyntaxHighlighter(grammar, [], **kwargs)
+		first.begin()
+		for line in lines[a:b]:
+			first.process(line)
+			first.io.clear()
+		second = SyntaxHighlighter(grammar, [], **kwargs)
+		second.begin()
+		i = b
+		while True:
+			key = first.state_key()
+			converged = key is not None and key == second.state_key()
+			if converged or i == n:
+				break
+			for shl in (first, second):
+				shl.process(lines[i])
+				shl.io.clear()
+			i += 1
+		if converged or not a:
+			if dbg: dbg(f"resyncstate: {'converged' if converged else 'no convergence'} {n - i} lines before the end, window: {window}")
+			for line in lines[i:]:
+				first.process(line)
+				first.io.clear()
+			return first.save_state()
+		window *= 2
+
+
+# Grammars of the syntaxes a --stats worker process has used, by name
+stats_grammars = {}
+
+
+def filestats(job:tuple):
+	# tokenizes a file, no rendering -> (path, error, lines, Profiler, {scope stack name: [tokens, chars]})
+	path, syntax_name, kwargs = job
+	try:
+		grammar = stats_grammars.get(syntax_name, None)
+		if grammar is None:
+			grammar = stats_grammars[syntax_name] = Grammar(
+				parsesyntax(loadsyntax(os.path.join(syntax_dir_path, f"{syntax_name}.{sublsynt_ext}")))
+			)
+		events = []
+		profiler = Profiler(timing=False)
+		shl = SyntaxHighlighter(grammar, events, profiler=profiler, **kwargs)
+		# by scope stack tuple here, atom ids don't mean anything to other processes
+		stacks = {}
+		scopestack = ()
+		nlines = 0
+		def count():
+			nonlocal scopestack
+			for event in events:
+				if event.__class__ is str:
+					entry = stacks.get(scopestack, None)
+					if entry is None:
+						entry = stacks[scopestack] = [0, 0]
+					entry[0] += 1
+					entry[1] += len(event)
+				else:
+					scopestack = event[0]
+			events.clear()
+		with open(path, "rb", buffering=0) as f:
+			shl.begin()
+			for line in readlines(f):
+				shl.process(line)
+				count()
+				nlines += 1
+			shl.end()
+			count()
+		return path, None, nlines, profiler, {" ".join(map(scopename, k)): v for k, v in stacks.items()}
+	except Exception as e:
+		return path, f"{e.__class__.__name__}: {e}", 0, None, None
+
+
+def corpusstats(paths:list, syntax_name:str=None, jobs:int=None, **kwargs):
+	# -> scope stack, scope, rule and context statistics of the files in paths (directories are
+	# searched), tokenized in a process pool; syntaxes by file extension unless syntax_name
+	from multiprocessing import Pool
+	files = []
+	for path in paths:
+		if os.path.isdir(path):
+			for dirpath, dirnames, filenames in os.walk(path):
+				dirnames[:] = sorted(filter(lambda x:not x.startswith("."), dirnames))
+				files.extend(map(lambda x:os.path.join(dirpath, x), sorted(filenames)))
+		else:
+			files.append(path)
+	by_ext = {}
+	if syntax_name is None:
+		fastloadpatts = (re.compile("^file_extensions:"),)
+		for name, syntax in loadsyntaxesmp(all_syntaxes_paths, lambda path:loadsyntax_until(path, fastloadpatts, cache=False)).items():
+			for ext in (syntax or {}).get("file_extensions", None) or ():
+				by_ext.setdefault(ext, name)
+	jobs_args = []
+	skipped = []
+	for path in files:
+		name = syntax_name or by_ext.get(os.path.splitext(path)[1].lstrip("."), None)
+		if name is None:
+			skipped.append(path)
+		else:
+			jobs_args.append((path, name, kwargs))
+	profiler = Profiler(timing=False)
+	stacks = {}
+	errors = {}
+	nfiles = nlines = 0
+	with Pool(jobs) as pool:
+		for path, error, file_lines, file_profiler, file_stacks in pool.imap_unordered(filestats, jobs_args):
+			if error:
+				errors[path] = error
+				continue
+			nfiles += 1
+			nlines += file_lines
+			profiler.merge(file_profiler)
+			for name, (tokens, chars) in file_stacks.items():
+				entry = stacks.get(name, None)
+				if entry is None:
+					entry = stacks[name] = [0, 0]
+				entry[0] += tokens
+				entry[1] += chars
+	scopes = {}
+	for name, (tokens, chars) in stacks.items():
+		for scope in set(name.split(" ")) if name else ():
+			scopes[scope] = scopes.get(scope, 0) + chars
+	stats = profiler.stats()
+	return {
+		"files": nfiles,
+		"lines": nlines,
+		"chars": sum(map(lambda x:x[1], stacks.values())),
+		"scope_stacks": [
+			{"scopes": name, "tokens": tokens, "chars": chars}
+			for name, (tokens, chars) in sorted(stacks.items(), key=lambda x:(-x[1][1], x[0]))
+		],
+		"scopes": [
+			{"scope": scope, "chars": chars}
+			for scope, chars in sorted(scopes.items(), key=lambda x:(-x[1], x[0]))
+		],
+		# counts only, the workers don't time the match attempts
+		"rules": [
+			dict(filter(lambda x:x[0] != "time_ns", action.items()))
+			for action in sorted(stats["actions"], key=lambda x:x["hits"], reverse=True)
+		],
+		"contexts": stats["contexts"],
+		"branch_rollbacks": stats["branch_rollbacks"],
+		"skipped": skipped,
+		"errors": errors,
+	}
+
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-s", "--syntax", type=str, help="sublime-syntax to use", nargs="?", default=None)
-	parser.add_argument("-c", "--color-scheme", type=str, help="sublime-color-scheme to use", nargs="?", default="Default")
+	parser.add_argument("-c", "--color-scheme", type=str, help="sublime-color-scheme to use, repeat it to render the same tokenization with several", action="append", default=None)
+	parser.add_argument("-o", "--output", type=str, help="output file, one per --color-scheme in the same order, - for stdout", action="append", default=None)
 	parser.add_argument("-d", "--debug", action="store_true", help="turn debugging on", default=False)
 	parser.add_argument("-S", "--show-scopes", action="store_true", help="output scopes tags", default=False)
+	parser.add_argument("--profile", action="store_true", help="count match attempts, context pushes and color cache misses, report them to stderr", default=False)
+	parser.add_argument("--flush", type=str, help="output flush policy", choices=flush_policies, default="adaptive")
+	parser.add_argument("--flush-size", type=int, help="flush once this many characters are buffered (size, adaptive)", default=65536)
+	parser.add_argument("--flush-interval", type=float, help="max seconds to hold buffered output (interval, adaptive)", default=0.1)
+	parser.add_argument("--encoding", type=str, help="input and output encoding", default="utf-8")
+	parser.add_argument("--errors", type=str, help="how to handle undecodable input bytes, surrogateescape passes them through untouched", choices=decode_errors, default="replace")
+	parser.add_argument("--mmap", action="store_true", help="memory-map input_file instead of reading it, if it's a regular file", default=False)
+	parser.add_argument("--line-max-bytes", type=int, help="write longer lines without highlighting them", default=0)
+	parser.add_argument("--line-max-time", type=float, help="stop highlighting a line after this many seconds of cpu time, write the rest of it as is", default=0.0)
+	parser.add_argument("--line-cache", type=float, help="memoize highlighting of repeated lines, up to this many MiB", default=0)
+	parser.add_argument("--scorer", type=str, help="color scheme rule scoring engine, auto switches to numpy (if installed) once the color cache keeps missing", choices=scorer_engines, default="auto")
+	parser.add_argument("--no-cache", action="store_true", help="don't read or write precompiled color schemes in $XDG_CACHE_HOME/sublhighlight", default=False)
+	parser.add_argument("--html", action="store_true", help="output html instead of ansi escapes", default=False)
+	parser.add_argument("--lines", type=str, help="only output lines A:B (1-based, inclusive, either side may be omitted)", default=None)
+	parser.add_argument("--save-stream", type=str, help="also save the tokenization as a scope stream, to render it later with --from-stream", default=None)
+	parser.add_argument("--from-stream", action="store_true", help="input_file is a scope stream saved with --save-stream, render it without highlighting again", default=False)
+	parser.add_argument("--stats", type=str, nargs="+", help="tokenize these files and directories in a process pool without rendering, write scope stack, scope, rule and context statistics as json", default=None)
+	parser.add_argument("-j", "--jobs", type=int, help="processes --stats uses, default: one per cpu", default=None)
+	parser.add_argument("--grep", type=str, help="only output the lines matching this regex, the others are tokenized but not rendered", default=None)
+	parser.add_argument("-A", "--after-context", type=int, help="lines to output after each --grep match", default=None)
+	parser.add_argument("-B", "--before-context", type=int, help="lines to output before each --grep match", default=None)
+	parser.add_argument("-C", "--context", type=int, help="lines to output before and after each --grep match", default=None)
+	parser.add_argument("--follow", action="store_true", help="highlight the last lines of input_file, then what gets appended to it, like tail -f", default=False)
+	parser.add_argument("--follow-lines", type=int, help="lines of input_file --follow starts with", default=10)
+	parser.add_argument("--pager", action="store_true", help="page the output in the terminal, highlighting only the lines shown", default=False)
+	parser.add_argument("--pager-lookahead", type=int, help="lines the pager highlights past the screen while waiting for keys", default=200)
 	parser.add_argument("-ls", "--list-syntaxes", action="store_true", help="list available syntaxes", default=False)
 	parser.add_argument("-lc", "--list-color-schemes", action="store_true", help="list available color schemes", default=False)
 	parser.add_argument("input_file", type=str, help="input file", nargs="?", default=None)
 	args = parser.parse_args()
-	global dbg
+	color_schemes = args.color_scheme or ["Default"]
+	output_paths = args.output or ["-"]
+	if len(output_paths) != len(color_schemes):
+		parser.error("expecting one --output per --color-scheme")
+	try:
+		line_start, line_stop = parselinerange(args.lines) if args.lines else (0, None)
+	except ValueError as e:
+		parser.error(str(e))
+	try:
+		grep_pattern = re.compile(args.grep) if args.grep is not None else None
+	except re.error as e:
+		parser.error(f"invalid --grep regex: {e}")
+	if args.follow and (not args.input_file or args.from_stream):
+		parser.error("--follow needs an input_file to follow")
 	if args.debug:
 		dbg = print
 		if dbg: dbg("="*20)
 	else:
 		dbg = None
+	hlrender.dbg = dbg
 	if args.list_syntaxes:
 		import json
 		print(
@@ -637,66 +1330,264 @@ if __name__ == "__main__":
 		)
 	if args.list_syntaxes or args.list_color_schemes:
 		exit()
+	if args.stats:
+		import json
+		json.dump(
+			corpusstats(
+				args.stats,
+				args.syntax,
+				args.jobs,
+				line_max_bytes=args.line_max_bytes,
+				line_max_time=args.line_max_time
+			),
+			sys.stdout,
+			indent=2
+		)
+		print()
+		exit()
 	first_stdin_line = None
-	input_stream = open(args.input_file, "r") if args.input_file else sys.stdin
-	if args.syntax is None:
-		fastloadpatts = (re.compile("^file_extensions:"), re.compile("^first_line_match"))
-		all_syntaxes = loadsyntaxesmp(all_syntaxes_paths, lambda path:loadsyntax_until(path, fastloadpatts, cache=False))
-		if args.input_file:
-			file_ext = os.path.splitext(args.input_file)[1].lstrip(".")
-			for syntax_name, syntax in all_syntaxes.items():
-				if syntax:
-					file_extensions = syntax.get("file_extensions", [])
-					if file_ext in file_extensions:
-						args.syntax = syntax_name
-						break
+	# termios, not on windows
+	use_pager = args.pager and not args.from_stream and not args.follow and not args.html and not args.debug and sys.stdout.isatty()
+	# every output restores the escaped bytes on its own, the pager shows U+FFFD
+	output_escapes = list(map(lambda x:deque(), output_paths)) if args.errors == "surrogateescape" and not args.debug and not use_pager else None
+	escapes = (output_escapes[0] if len(output_escapes) == 1 else EscapesTee(*output_escapes)) if output_escapes else None
+	outputs = list(
+		map(
+			lambda x: FlushingWriter(
+				sys.stdout.buffer if x[1] == "-" else open(x[1], "wb"),
+				policy=args.flush,
+				size=args.flush_size,
+				interval=args.flush_interval,
+				encoding=args.encoding,
+				errors="surrogateescape" if output_escapes else "replace",
+				escapes=output_escapes[x[0]] if output_escapes else None
+			) if not args.debug else StringIO(),
+			enumerate(output_paths)
+		)
+	)
+	profiler = Profiler() if args.profile else None
+	renderers = list(
+		map(
+			lambda x: (HtmlRenderer if args.html else AnsiRenderer)(
+				loadparsedcolorscheme(
+					os.path.abspath(
+						os.path.join(
+							color_scheme_dir_path,
+							f"{x}.{sublcolscheme_ext}"
+						)
+					),
+					cache=not args.no_cache
+				),
+				profiler=profiler,
+				scorer=args.scorer
+			),
+			color_schemes
+		)
+	)
+	if args.from_stream:
+		reader = ScopeStreamReader(open(args.input_file, "rb") if args.input_file else sys.stdin.buffer)
+		shl = None
+	else:
+		if args.follow:
+			follow_offset = tailoffset(args.input_file, args.follow_lines)
+			input_lines = readlines(
+				FollowStream(args.input_file, follow_offset, outputs if not args.debug else ()),
+				encoding=args.encoding,
+				errors=args.errors,
+				escapes=escapes
+			)
+		elif args.mmap and args.input_file and mmapable(args.input_file, args.encoding):
+			input_lines = mmaplines(
+				args.input_file,
+				encoding=args.encoding,
+				errors=args.errors,
+				escapes=escapes
+			)
+		else:
+			input_lines = readlines(
+				open(args.input_file, "rb", buffering=0) if args.input_file else sys.stdin.buffer,
+				outputs if not args.debug else (),
+				encoding=args.encoding,
+				errors=args.errors,
+				escapes=escapes
+			)
 		if args.syntax is None:
-			for line in input_stream:
-				first_stdin_line = line
+			fastloadpatts = (re.compile("^file_extensions:"), re.compile("^first_line_match"))
+			all_syntaxes = loadsyntaxesmp(all_syntaxes_paths, lambda path:loadsyntax_until(path, fastloadpatts, cache=False))
+			if args.input_file:
+				file_ext = os.path.splitext(args.input_file)[1].lstrip(".")
 				for syntax_name, syntax in all_syntaxes.items():
 					if syntax:
-						first_line_match = syntax.get("first_line_match", None)
-						if first_line_match:
-							if re.match(first_line_match, line):
-								args.syntax = syntax_name
-								break
-				break
-		del all_syntaxes
-	if args.syntax is None:
-		args.syntax = "Default"
-	main_syntax_path = os.path.abspath(
-		os.path.join(
-			syntax_dir_path,
-			f"{args.syntax}.{sublsynt_ext}"
+						file_extensions = syntax.get("file_extensions", [])
+						if file_ext in file_extensions:
+							args.syntax = syntax_name
+							break
+			if args.syntax is None:
+				first_stdin_line = next(input_lines, None)
+				if first_stdin_line is not None:
+					for syntax_name, syntax in all_syntaxes.items():
+						if syntax:
+							first_line_match = syntax.get("first_line_match", None)
+							if first_line_match:
+								if re.match(first_line_match, first_stdin_line):
+									args.syntax = syntax_name
+									break
+			del all_syntaxes
+		if args.syntax is None:
+			args.syntax = "Default"
+		main_syntax_path = os.path.abspath(
+			os.path.join(
+				syntax_dir_path,
+				f"{args.syntax}.{sublsynt_ext}"
+			)
 		)
-	)
-	main_syntax = parsesyntax(
-		loadsyntax(main_syntax_path)
-	)
-	color_scheme_path = os.path.abspath(
-		os.path.join(
-			color_scheme_dir_path,
-			f"{args.color_scheme}.{sublcolscheme_ext}"
+		main_syntax = parsesyntax(
+			loadsyntax(main_syntax_path)
 		)
-	)
-	color_scheme = parsecolorscheme(
-		loadcolorscheme(color_scheme_path)
-	)
-	output = sys.stdout if not args.debug else StringIO()
-	shl = SyntaxHighlighter(
-		main_syntax,
-		color_scheme,
-		output,
-		show_scopes=args.show_scopes
-	)
-	shl.begin()
-	if first_stdin_line:
-		shl.process(first_stdin_line)
-		output.flush()
-	for line in input_stream:
-		shl.process(line)
-		output.flush()
-	shl.end()
+		events = []
+		grammar = Grammar(main_syntax)
+		grammar.prefetch()
+		shl = SyntaxHighlighter(
+			grammar,
+			events,
+			show_scopes=args.show_scopes,
+			profiler=profiler,
+			line_cache=LineCache(int(args.line_cache * 1024 * 1024)) if args.line_cache > 0 else None,
+			line_max_bytes=args.line_max_bytes,
+			line_max_time=args.line_max_time
+		)
+		if args.follow:
+			# the state the lines before the followed ones leave, from a bounded piece of the file
+			follow_state = resyncstate(
+				grammar,
+				*readhistory(args.input_file, follow_offset, encoding=args.encoding, errors=args.errors),
+				line_max_bytes=args.line_max_bytes,
+				line_max_time=args.line_max_time
+			)
+	if use_pager:
+		from hlpager import Pager
+		pager = Pager(
+			shl,
+			renderers[0],
+			chain((first_stdin_line,), input_lines) if first_stdin_line else input_lines,
+			name=args.input_file or "stdin",
+			lookahead=args.pager_lookahead
+		)
+		pager.run(sys.stdout.buffer)
+		exit()
+	stream_writer = ScopeStreamWriter(open(args.save_stream, "wb")) if args.save_stream and shl else None
+	line_range = LineRange(line_start, line_stop) if args.lines and shl else None
+	grep_filter = GrepFilter(
+		grep_pattern,
+		before=args.before_context if args.before_context is not None else args.context or 0,
+		after=args.after_context if args.after_context is not None else args.context or 0
+	) if grep_pattern else None
+	def render(events:list):
+		# tokenized once, rendered once per color scheme
+		for renderer, output in zip(renderers, outputs):
+			renderer.render(events, output)
+			if args.debug:
+				output.flush()
+			else:
+				output.line_done()
+	# the events written after a process() aren't always those of its line, see LineSplitter
+	splitter = LineSplitter() if stream_writer or line_range or grep_filter else None
+	# input lines whose events haven't been split out yet: --grep matches them, the text of the
+	# events has the scope names of --show-scopes too
+	grep_texts = deque()
+	def line_done(text:str=None, final:bool=False):
+		if not splitter:
+			render(events)
+			events.clear()
+			return
+		if grep_filter and text is not None:
+			grep_texts.append(text)
+			if (
+				len(grep_texts) == 1
+				and not stream_writer
+				and not line_range
+				and not grep_filter.wants(text)
+				and lineended(events)
+			):
+				# the events are those of this line only, which won't be written: no splitting,
+				# no rendering, only the color they leave
+				grep_texts.clear()
+				grep_filter.skip(splitter.end(), events)
+				events.clear()
+				if output_escapes:
+					for output in outputs:
+						output.discard(text)
+				return
+		lines = splitter.split(events)
+		events.clear()
+		if final:
+			rest = splitter.end()
+			if rest:
+				lines.append(rest)
+		for line_events in lines:
+			text = grep_texts.popleft() if grep_texts else None
+			if stream_writer:
+				stream_writer.line(line_events)
+			selected = line_range.select(line_events) if line_range else line_events
+			if selected is not None and grep_filter:
+				# color changes after the last line ending aren't a line to match
+				selected = grep_filter.select(text, selected) if text is not None else None
+			if selected is not None:
+				render(selected)
+			elif output_escapes:
+				text = linetext(line_events) if text is None else text
+				for output in outputs:
+					output.discard(text)
+	for renderer, output in zip(renderers, outputs):
+		renderer.begin(output)
+	try:
+		if shl:
+			if args.follow:
+				shl.restore_state(follow_state)
+				shl.write_color()
+			else:
+				shl.begin()
+			if first_stdin_line:
+				shl.process(first_stdin_line)
+				line_done(first_stdin_line)
+			for line in input_lines:
+				shl.process(line)
+				line_done(line)
+			shl.end()
+		else:
+			for events in reader.lines(line_start, line_stop):
+				if grep_filter:
+					events = grep_filter.select(linetext(events), events)
+					if events is None:
+						continue
+				render(events)
+	except KeyboardInterrupt:
+		if not args.follow:
+			raise
+	finally:
+		if shl:
+			# also whatever was tokenized before an error
+			line_done(final=True)
+		if stream_writer:
+			stream_writer.close()
+			stream_writer.stream.close()
+		if line_stop is not None or grep_filter:
+			# back to the scheme's defaults, as after the last line
+			render([((), None)])
+		for renderer, output in zip(renderers, outputs):
+			renderer.end(output)
+			output.flush()
+	if profiler:
+		profiler.report(sys.stderr)
+		if shl and shl.line_cache:
+			print(shl.line_cache, file=sys.stderr)
+		if shl:
+			print(f"degraded lines: {shl.degraded_lines}", file=sys.stderr)
 	if args.debug:
-		print(output.getvalue())
-		output.close()
+		for output in outputs:
+			print(output.getvalue())
+			output.close()
+	else:
+		for output in outputs:
+			if output.stream is not sys.stdout.buffer:
+				output.stream.close()
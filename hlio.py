@@ -0,0 +1,348 @@
+import codecs
+import ctypes
+import io
+import mmap
+import os
+import re
+import select
+from collections import deque
+from itertools import chain
+from time import (
+	monotonic,
+	sleep,
+)
+
+
+flush_policies = ("line", "size", "interval", "adaptive")
+decode_errors = ("replace", "surrogateescape", "strict")
+re_escaped = re.compile("[\ufffd\udc80-\udcff]")
+# inotify_add_watch() mask: IN_MODIFY | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+inotify_mask = 0x2 | 0x4 | 0x400 | 0x800
+linebreaks = ("\r", "\x0b", "\x0c", "\x1c", "\x1d", "\x1e", "\x85", "\u2028", "\u2029")
+
+
+class FlushingWriter:
+
+	def __init__(
+		self,
+		stream,
+		policy:str="adaptive",
+		size:int=65536,
+		interval:float=0.1,
+		encoding:str="utf-8",
+		errors:str="replace",
+		escapes:deque=None
+	):
+		if policy not in flush_policies:
+			raise ValueError(f"unknown flush policy: {policy}, expecting one of: {', '.join(flush_policies)}")
+		self.stream = stream
+		self.policy = policy
+		self.flush_size = size
+		self.flush_interval = interval
+		self.encoding = encoding
+		self.errors = errors
+		self.escapes = escapes
+		self.parts = []
+		self.size = 0
+		self.deadline = None
+
+	def write(self, s:str):
+		self.parts.append(s)
+		self.size += len(s)
+
+	def flush(self):
+		if self.parts:
+			data = "".join(self.parts)
+			self.parts.clear()
+			self.size = 0
+			if self.escapes and "\ufffd" in data:
+				data = self.unescape(data)
+			self.stream.write(data.encode(self.encoding, self.errors))
+		self.deadline = None
+		self.stream.flush()
+
+	def unescape(self, data:str):
+		# the engine only ever saw U+FFFD in place of undecodable bytes, put back what the reader replaced
+		escapes = self.escapes
+		chunks = data.split("\ufffd")
+		out = [chunks[0]]
+		for chunk in chunks[1:]:
+			out.append(escapes.popleft() if escapes else "\ufffd")
+			out.append(chunk)
+		return "".join(out)
+
+	def discard(self, text:str):
+		# text read but not written: drop its escaped bytes, they come after those of the text
+		# waiting to be flushed
+		escapes = self.escapes
+		n = text.count("\ufffd")
+		if not n or not escapes:
+			return
+		pending = sum(map(lambda x:x.count("\ufffd"), self.parts))
+		for _ in range(min(n, len(escapes) - pending)):
+			del escapes[pending]
+
+	def line_done(self):
+		if not self.size:
+			return
+		policy = self.policy
+		if policy == "line":
+			self.flush()
+			return
+		if policy != "interval" and self.size >= self.flush_size:
+			self.flush()
+			return
+		if policy != "size":
+			now = monotonic()
+			if self.deadline is None:
+				self.deadline = now + self.flush_interval
+			elif now >= self.deadline:
+				self.flush()
+
+	def input_wait(self, fd:int):
+		if not self.size or self.policy in ("line", "size"):
+			return
+		if self.policy == "adaptive":
+			timeout = 0
+		else:
+			now = monotonic()
+			if self.deadline is None:
+				self.deadline = now + self.flush_interval
+			timeout = max(0.0, self.deadline - now)
+		try:
+			ready, _, _ = select.select([fd], [], [], timeout)
+		except (OSError, ValueError):
+			# select() not supported on this kind of stream (e.g. windows pipes)
+			return
+		if not ready:
+			self.flush()
+
+
+class EscapesTee:
+
+	# hands the escaped bytes of one reader to the writers of several outputs
+
+	def __init__(self, *queues):
+		self.queues = queues
+
+	def append(self, escaped:str):
+		for queue in self.queues:
+			queue.append(escaped)
+
+
+def inotifyfd(path:str):
+	# -> inotify fd watching path for changes, None if there's no inotify (not linux)
+	try:
+		libc = ctypes.CDLL(None, use_errno=True)
+		inotify_init1 = libc.inotify_init1
+		inotify_add_watch = libc.inotify_add_watch
+	except (OSError, AttributeError, TypeError):
+		return None
+	fd = inotify_init1(os.O_CLOEXEC)
+	if fd < 0:
+		return None
+	if inotify_add_watch(fd, os.fsencode(path), inotify_mask) < 0:
+		os.close(fd)
+		return None
+	return fd
+
+
+class FollowStream:
+
+	# the bytes of a file from offset on, like tail -f: at the end of the file it waits for more
+	# instead of ending, woken up by inotify, or polling where there's none
+
+	def __init__(self, path:str, offset:int=0, writers:list=(), interval:float=0.25):
+		self.file = open(path, "rb", buffering=0)
+		self.file.seek(offset)
+		self.writers = writers
+		self.interval = interval
+		self.notify_fd = inotifyfd(path)
+
+	def read1(self, n:int):
+		f = self.file
+		while True:
+			data = f.read(n)
+			if data:
+				return data
+			if os.fstat(f.fileno()).st_size < f.tell():
+				# truncated, start over
+				f.seek(0)
+				continue
+			# nothing to read for now, don't hold back what's been highlighted
+			for writer in self.writers:
+				if writer.size:
+					writer.flush()
+			self.wait()
+
+	def wait(self):
+		if self.notify_fd is None:
+			sleep(self.interval)
+			return
+		# the timeout also catches changes inotify misses (e.g. network filesystems)
+		ready, _, _ = select.select([self.notify_fd], [], [], self.interval * 4)
+		if ready:
+			os.read(self.notify_fd, 4096)
+
+	def close(self):
+		if self.notify_fd is not None:
+			os.close(self.notify_fd)
+			self.notify_fd = None
+		self.file.close()
+
+
+def tailoffset(path:str, nlines:int, block_size:int=65536):
+	# -> offset of the start of the last nlines lines of path
+	with open(path, "rb") as f:
+		size = f.seek(0, os.SEEK_END)
+		if nlines <= 0:
+			return size
+		pos = size
+		if size:
+			f.seek(size - 1)
+			if f.read(1) == b"\n":
+				# the last line ending doesn't start a line
+				pos -= 1
+		while pos > 0:
+			start = max(0, pos - block_size)
+			f.seek(start)
+			block = f.read(pos - start)
+			i = len(block)
+			while True:
+				i = block.rfind(b"\n", 0, i)
+				if i < 0:
+					break
+				nlines -= 1
+				if not nlines:
+					return start + i + 1
+			pos = start
+	return 0
+
+
+def readhistory(path:str, offset:int, encoding:str="utf-8", errors:str="replace", size:int=1024 * 1024):
+	# -> (lines of path before offset, up to size bytes of them, whether they start at the beginning)
+	start = max(0, offset - size)
+	with open(path, "rb") as f:
+		if start:
+			f.seek(start - 1)
+			data = f.read(offset - start + 1)
+			# the first line is whole only if it follows a line ending
+			cut = data.find(b"\n") + 1 if data[:1] != b"\n" else 1
+			data = data[cut:] if cut else b""
+		else:
+			data = f.read(offset)
+	text = data.decode(encoding, errors)
+	if "\r" in text:
+		# same newline translation as text mode streams
+		text = text.replace("\r\n", "\n").replace("\r", "\n")
+	return splitlines(text), not start
+
+
+def readlines(*args, **kwargs):
+	return chain.from_iterable(readblocks(*args, **kwargs))
+
+
+def readblocks(
+	stream,
+	writers:list=(),
+	encoding:str="utf-8",
+	errors:str="replace",
+	escapes:deque=None,
+	chunk_size:int=65536
+):
+	try:
+		fd = stream.fileno()
+		read = lambda: os.read(fd, chunk_size)
+	except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+		fd = None
+		read = lambda: (stream.read1 if hasattr(stream, "read1") else stream.read)(chunk_size)
+	# same newline translation as text mode streams
+	decoder = io.IncrementalNewlineDecoder(
+		codecs.getincrementaldecoder(encoding)(errors),
+		translate=True
+	)
+	pending = ""
+	while True:
+		if fd is not None:
+			for writer in writers:
+				writer.input_wait(fd)
+		chunk = read()
+		text = decoder.decode(chunk, final=not chunk)
+		if pending:
+			text = pending + text
+		if not chunk:
+			if text:
+				yield splitlines(text, escapes)
+			return
+		cut = text.rfind("\n") + 1
+		if cut:
+			yield splitlines(text[:cut] if cut < len(text) else text, escapes)
+		pending = text[cut:]
+
+
+def mmaplines(*args, **kwargs):
+	return chain.from_iterable(mmapblocks(*args, **kwargs))
+
+
+def mmapblocks(
+	path:str,
+	encoding:str="utf-8",
+	errors:str="replace",
+	escapes:deque=None,
+	block_size:int=1024 * 1024,
+	release_size:int=64 * 1024 * 1024
+):
+	with open(path, "rb") as f:
+		try:
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			# empty file
+			return
+	with mm:
+		if hasattr(mm, "madvise"):
+			mm.madvise(mmap.MADV_SEQUENTIAL)
+		size = len(mm)
+		start = 0
+		released = 0
+		while start < size:
+			end = mm.rfind(b"\n", start, start + block_size) + 1
+			if not end:
+				# line longer than a block
+				end = mm.find(b"\n", start + block_size) + 1 or size
+			if size - end < block_size and mm.find(b"\n", end) < 0:
+				end = size
+			text = mm[start:end].decode(encoding, errors)
+			start = end
+			if "\r" in text:
+				# same newline translation as text mode streams
+				text = text.replace("\r\n", "\n").replace("\r", "\n")
+			yield splitlines(text, escapes)
+			if start - released >= release_size and hasattr(mm, "madvise"):
+				# drop the pages already highlighted so the mapping doesn't grow the resident set
+				released = start - start % mmap.PAGESIZE
+				mm.madvise(mmap.MADV_DONTNEED, 0, released)
+
+
+def mmapable(path:str, encoding:str):
+	return os.path.isfile(path) and "\n".encode(encoding) == b"\n"
+
+
+def splitlines(text:str, escapes:deque=None):
+	if escapes is not None and not text.isascii() and re_escaped.search(text):
+		text = escapeline(text, escapes)
+	if not any(map(text.__contains__, linebreaks)):
+		# fast path, "\n" is the only line boundary str.splitlines() will find
+		return text.splitlines(keepends=True)
+	lines = text.split("\n")
+	last = lines.pop()
+	lines = [line + "\n" for line in lines]
+	if last:
+		lines.append(last)
+	return lines
+
+
+def escapeline(line:str, escapes:deque):
+	# surrogateescape'd bytes cannot reach the regex engine, hand it U+FFFD and let the writer restore them
+	for m in re_escaped.finditer(line):
+		escapes.append(m.group())
+	return re_escaped.sub("\ufffd", line)
@@ -0,0 +1,351 @@
+import os
+import select
+import signal
+import sys
+import termios
+import threading
+import tty
+from collections import OrderedDict
+from io import StringIO
+from hlstream import LineSplitter
+
+
+# Pages the input in the terminal, highlighting only the lines on screen plus a look-ahead
+# window while waiting for keys. The engine state is saved every checkpoint_lines lines as
+# it goes: jumping forward tokenizes the skipped lines without rendering them, jumping back
+# restarts from the closest checkpoint before the lines to show. The input is read by a
+# thread, as far as the lines asked for, so a slow pipe doesn't keep the pager from
+# redrawing or quitting.
+
+checkpoint_lines = 256
+cache_lines = 4096
+tab_size = 8
+# caret notation for control characters, they'd move the cursor
+controls = dict(map(lambda c:(c, f"^{chr(c ^ 0x40)}"), (*range(0x20), 0x7f)))
+del controls[ord("\t")]
+keys = {
+	"q": "quit",
+	"Q": "quit",
+	"j": "down",
+	"e": "down",
+	"\r": "down",
+	"\n": "down",
+	"\x0e": "down",
+	"\x1b[B": "down",
+	"\x1bOB": "down",
+	"k": "up",
+	"y": "up",
+	"\x10": "up",
+	"\x1b[A": "up",
+	"\x1bOA": "up",
+	" ": "page_down",
+	"f": "page_down",
+	"\x06": "page_down",
+	"\x1b[6~": "page_down",
+	"b": "page_up",
+	"\x02": "page_up",
+	"\x1b[5~": "page_up",
+	"d": "half_down",
+	"\x04": "half_down",
+	"u": "half_up",
+	"\x15": "half_up",
+	"g": "top",
+	"<": "top",
+	"\x1b[H": "top",
+	"\x1bOH": "top",
+	"\x1b[1~": "top",
+	"G": "bottom",
+	">": "bottom",
+	"\x1b[F": "bottom",
+	"\x1bOF": "bottom",
+	"\x1b[4~": "bottom",
+}
+
+
+def readkeys(data:str):
+	# -> actions of the keys read at once, escape sequences are matched longest first
+	i = 0
+	while i < len(data):
+		n = 1
+		if data[i] == "\x1b":
+			n = next(filter(lambda x:data[i:i + x] in keys, range(min(6, len(data) - i), 0, -1)), 1)
+		action = keys.get(data[i:i + n], None)
+		if action is not None:
+			yield action
+		i += n
+
+
+def clip(events:list, width:int):
+	# events of a line cut to width columns, tabs expanded, line ending dropped
+	out = []
+	col = 0
+	for event in events:
+		if event.__class__ is not str:
+			out.append(event)
+			continue
+		text = event.rstrip("\r\n").translate(controls)
+		if "\t" in text:
+			parts = text.split("\t")
+			expanded = [parts[0]]
+			x = col + len(parts[0])
+			for part in parts[1:]:
+				expanded.append(" " * (tab_size - x % tab_size))
+				x += tab_size - x % tab_size
+				expanded.append(part)
+				x += len(part)
+			text = "".join(expanded)
+		if col + len(text) >= width:
+			out.append(text[:width - col])
+			break
+		out.append(text)
+		col += len(text)
+	return out
+
+
+class Pager:
+
+	def __init__(self, shl, renderer, lines, name:str="", lookahead:int=200):
+		self.shl = shl
+		self.renderer = renderer
+		self.source = iter(lines)
+		self.lines = []
+		self.eof = False
+		self.error = None
+		# lines the reader thread reads up to, it signals new lines on the wakeup pipe
+		self.wanted = 0
+		self.ready = threading.Condition()
+		self.wakeup_r, self.wakeup_w = os.pipe()
+		self.woken = False
+		self.name = name
+		self.lookahead = lookahead
+		# line number -> (engine state, color in effect) at its start
+		self.checkpoints = {}
+		# line number -> its events, the first one the color in effect at its start
+		self.line_events = OrderedDict()
+		# line the engine is at, None before begin(), the line its events are being split into
+		self.next_line = None
+		self.assembling = 0
+		self.splitter = LineSplitter()
+		# color in effect at the start of the line being split
+		self.color = None
+		# lines before this one are tokenized but not kept
+		self.keep_from = 0
+		self.out = []
+		self.top = 0
+		# the last lines are shown as they're read, after a jump to the bottom
+		self.at_bottom = False
+		# (lines read, end of input) when the screen was drawn
+		self.shown = (0, False)
+		self.resized = False
+		threading.Thread(target=self.read, daemon=True).start()
+
+	def read(self):
+		# reader thread
+		try:
+			while True:
+				with self.ready:
+					while len(self.lines) >= self.wanted:
+						self.ready.wait()
+				line = next(self.source, None)
+				if line is None:
+					break
+				with self.ready:
+					self.lines.append(line)
+					self.ready.notify_all()
+				self.wake()
+		except Exception as e:
+			self.error = e
+		with self.ready:
+			self.eof = True
+			self.ready.notify_all()
+		self.wake()
+
+	def wake(self):
+		if not self.woken:
+			self.woken = True
+			os.write(self.wakeup_w, b"\0")
+
+	def fill(self, n:int, timeout:float=0.1):
+		# -> number of lines read, asks the reader for n and waits for them up to timeout seconds
+		with self.ready:
+			if n > self.wanted:
+				self.wanted = n
+				self.ready.notify_all()
+			if timeout:
+				self.ready.wait_for(lambda:len(self.lines) >= n or self.eof, timeout)
+			if self.error is not None:
+				raise self.error
+			return len(self.lines)
+
+	def split(self):
+		# assigns the events the engine wrote to the lines their text belongs to
+		for line_events in self.splitter.split(self.out):
+			self.linedone(line_events)
+		self.out.clear()
+
+	def linedone(self, events:list):
+		if self.assembling >= self.keep_from:
+			self.line_events[self.assembling] = [self.color] + events if self.color else events
+			self.line_events.move_to_end(self.assembling)
+			while len(self.line_events) > cache_lines:
+				self.line_events.popitem(last=False)
+		self.assembling += 1
+		self.color = next(filter(lambda x:x.__class__ is tuple, reversed(events)), self.color)
+
+	def colornow(self):
+		# color in effect after the events split so far, for a checkpoint
+		return next(filter(lambda x:x.__class__ is tuple, reversed(self.splitter.current)), self.color)
+
+	def restart(self, line:int):
+		# engine back to the closest checkpoint at or before line
+		shl = self.shl
+		at = max(filter(lambda x:x <= line, self.checkpoints), default=None)
+		self.out.clear()
+		shl.io = self.out
+		self.splitter = LineSplitter()
+		if at is None:
+			shl.contextstack = []
+			shl.scopestack = ()
+			shl.scopepops = []
+			self.color = None
+			self.assembling = self.next_line = 0
+			shl.begin()
+			self.split()
+			self.checkpoints[0] = (shl.save_state(), self.colornow())
+			return
+		state, self.color = self.checkpoints[at]
+		shl.restore_state(state)
+		self.assembling = self.next_line = at
+
+	def highlight(self, start:int, stop:int, steps:int=None, timeout:float=0.1):
+		# makes sure the events of lines [start, stop) are known, -> False once they are, or the
+		# lines aren't read yet; with steps, returns after tokenizing that many lines
+		stop = min(stop, self.fill(stop, timeout))
+		start = next(filter(lambda x:x not in self.line_events, range(start, stop)), None)
+		if start is None:
+			return False
+		if self.next_line is None or self.assembling > start:
+			self.restart(start)
+		self.keep_from = start
+		shl = self.shl
+		while self.assembling < stop:
+			i = self.next_line
+			if i >= self.fill(i + 1, 0):
+				if not self.eof:
+					break
+				if shl.contextstack:
+					shl.end()
+					self.split()
+				rest = self.splitter.end()
+				if any(map(lambda x:x.__class__ is str, rest)):
+					self.linedone(rest)
+				break
+			if not i % checkpoint_lines and i not in self.checkpoints and self.assembling == i and shl.state_key() is not None:
+				self.checkpoints[i] = (shl.save_state(), self.colornow())
+			shl.process(self.lines[i])
+			self.next_line = i + 1
+			self.split()
+			if steps is not None:
+				steps -= 1
+				if not steps:
+					return True
+		return False
+
+	def render(self, line:int, width:int):
+		out = StringIO()
+		self.renderer.render(clip(self.line_events.get(line, ()), width), out)
+		return out.getvalue()
+
+	def draw(self, out, width:int, height:int):
+		rows = height - 1
+		self.highlight(self.top, self.top + rows)
+		frame = ["\x1b[H"]
+		for row in range(rows):
+			line = self.top + row
+			if line < len(self.lines):
+				frame.append(self.render(line, width))
+			else:
+				frame.append("\x1b[0m~")
+			frame.append("\x1b[0m\x1b[K\r\n")
+		self.shown = (len(self.lines), self.eof)
+		total = len(self.lines) if self.eof else f"{len(self.lines)}+"
+		last = min(self.top + rows, len(self.lines))
+		status = f"{self.name} lines {self.top + 1}-{last} of {total}{' (END)' if self.eof and last >= len(self.lines) else ''}"
+		frame.append(f"\x1b[7m{status[:width]}\x1b[0m\x1b[K")
+		out.write("".join(frame).encode("utf-8", "replace"))
+		out.flush()
+
+	def scroll(self, action:str, rows:int):
+		top = self.top
+		self.at_bottom = action == "bottom"
+		if action == "down":
+			top += 1
+		elif action == "up":
+			top -= 1
+		elif action == "page_down":
+			top += rows
+		elif action == "page_up":
+			top -= rows
+		elif action == "half_down":
+			top += rows // 2
+		elif action == "half_up":
+			top -= rows // 2
+		elif action == "top":
+			top = 0
+		elif action == "bottom":
+			# the whole input has to be read, the lines in between are only tokenized; what's read
+			# so far for now
+			top = self.fill(sys.maxsize) - rows
+		if top > self.top:
+			# not past the last screenful
+			top = min(top, max(self.fill(top + rows) - rows, self.top))
+		self.top = max(0, top)
+
+	def onresize(self, signum, frame):
+		self.resized = True
+
+	def run(self, out, tty_path:str="/dev/tty"):
+		fd = os.open(tty_path, os.O_RDONLY)
+		attrs = termios.tcgetattr(fd)
+		prev_handler = signal.signal(signal.SIGWINCH, self.onresize)
+		try:
+			tty.setcbreak(fd)
+			# alternate screen, no cursor
+			out.write(b"\x1b[?1049h\x1b[?25l")
+			while True:
+				width, height = os.get_terminal_size(out.fileno())
+				rows = max(1, height - 1)
+				self.resized = False
+				self.draw(out, width, max(2, height))
+				# look ahead while there's no key to read
+				redraw = False
+				while not self.resized and not redraw:
+					busy = self.highlight(self.top + rows, self.top + rows + self.lookahead, steps=16, timeout=0)
+					ready, _, _ = select.select([fd, self.wakeup_r], [], [], 0 if busy else 0.25)
+					if self.wakeup_r in ready:
+						self.woken = False
+						os.read(self.wakeup_r, 4096)
+						if self.at_bottom:
+							self.top = max(0, len(self.lines) - rows)
+							redraw = True
+						else:
+							# lines missing on screen, or the end of the input
+							shown_lines, shown_eof = self.shown
+							redraw = shown_lines < self.top + rows or shown_eof != self.eof
+					if fd in ready:
+						break
+				if self.resized or fd not in ready:
+					continue
+				actions = list(readkeys(os.read(fd, 32).decode("latin-1")))
+				if "quit" in actions:
+					break
+				for action in actions:
+					self.scroll(action, rows)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			out.write(b"\x1b[0m\x1b[?25h\x1b[?1049l")
+			out.flush()
+			termios.tcsetattr(fd, termios.TCSADRAIN, attrs)
+			signal.signal(signal.SIGWINCH, prev_handler)
+			os.close(fd)
@@ -0,0 +1,155 @@
+import sys
+import zlib
+
+
+def addcounts(actions:dict, key, attempts:int, hits:int, time_ns:int, pattern:str):
+	entry = actions.get(key, None)
+	if entry is None:
+		entry = actions[key] = [0, 0, 0, pattern]
+	entry[0] += attempts
+	entry[1] += hits
+	entry[2] += time_ns
+
+
+class Profiler:
+
+	def __init__(self, timing:bool=True):
+		# without timing, only counts: no clock reads around every match attempt
+		self.timing = timing
+		# counts are by id() of the action list of a context, which lives as long as the Grammar,
+		# labels (syntax name, context label) are looked up once per action list
+		self.labels = {}
+		self.actions = {}
+		self.pushes = {}
+		self.pops = {}
+		# totals() of merged profilers
+		self.merged = ({}, {}, {})
+		self.branch_rollbacks = 0
+		self.color_cache_hits = 0
+		self.color_cache_misses = 0
+
+	@staticmethod
+	def ctx_label(rtctx):
+		# anonymous contexts by a hash of their definition, the same in every process: their
+		# actions mustn't add up with those of other anonymous contexts
+		if rtctx.name.startswith("["):
+			return f"<anonymous {zlib.crc32(rtctx.name.encode('utf-8', 'surrogatepass')):08x}>"
+		return rtctx.name
+
+	def label(self, rtctx):
+		key = id(rtctx.actionlist)
+		if key not in self.labels:
+			self.labels[key] = (rtctx.syntax["name"], self.ctx_label(rtctx))
+
+	def match(self, rtctx, action_id, actiondef, matched:bool, elapsed_ns:int):
+		key = (id(rtctx.actionlist), action_id)
+		entry = self.actions.get(key, None)
+		if entry is None:
+			self.label(rtctx)
+			patt = actiondef["match"]
+			entry = self.actions[key] = [0, 0, 0, getattr(patt, "_pattern", patt)]
+		entry[0] += 1
+		if matched:
+			entry[1] += 1
+		entry[2] += elapsed_ns
+
+	def push(self, rtctx):
+		key = id(rtctx.actionlist)
+		counts = self.pushes
+		if key in counts:
+			counts[key] += 1
+		else:
+			self.label(rtctx)
+			counts[key] = 1
+
+	def pop(self, rtctx):
+		key = id(rtctx.actionlist)
+		counts = self.pops
+		if key in counts:
+			counts[key] += 1
+		else:
+			self.label(rtctx)
+			counts[key] = 1
+
+	def totals(self):
+		# -> actions {(syntax name, context label, action id): [attempts, hits, time_ns, pattern]},
+		# pushes and pops {(syntax name, context label): count}, merged profilers included
+		merged_actions, merged_pushes, merged_pops = self.merged
+		actions = {k: v[:] for k, v in merged_actions.items()}
+		pushes = dict(merged_pushes)
+		pops = dict(merged_pops)
+		labels = self.labels
+		for (key, action_id), (attempts, hits, time_ns, pattern) in self.actions.items():
+			addcounts(actions, (*labels[key], action_id), attempts, hits, time_ns, pattern)
+		for counts, total in ((self.pushes, pushes), (self.pops, pops)):
+			for key, n in counts.items():
+				label = labels[key]
+				total[label] = total.get(label, 0) + n
+		return actions, pushes, pops
+
+	def merge(self, other):
+		# adds the counts of another Profiler, e.g. of a worker process
+		actions, pushes, pops = other.totals()
+		merged_actions, merged_pushes, merged_pops = self.merged
+		for key, (attempts, hits, time_ns, pattern) in actions.items():
+			addcounts(merged_actions, key, attempts, hits, time_ns, pattern)
+		for counts, total in ((pushes, merged_pushes), (pops, merged_pops)):
+			for key, n in counts.items():
+				total[key] = total.get(key, 0) + n
+		self.branch_rollbacks += other.branch_rollbacks
+		self.color_cache_hits += other.color_cache_hits
+		self.color_cache_misses += other.color_cache_misses
+
+	def stats(self):
+		actions, pushes, pops = self.totals()
+		return {
+			"actions": [
+				{
+					"syntax": syntax,
+					"context": ctx,
+					"action": action_id,
+					"pattern": pattern,
+					"attempts": attempts,
+					"hits": hits,
+					"misses": attempts - hits,
+					"time_ns": time_ns,
+				}
+				for (syntax, ctx, action_id), (attempts, hits, time_ns, pattern) in sorted(
+					actions.items(),
+					key=lambda x:x[1][2],
+					reverse=True
+				)
+			],
+			"contexts": [
+				{
+					"syntax": syntax,
+					"context": ctx,
+					"pushes": n,
+					"pops": pops.get((syntax, ctx), 0),
+				}
+				for (syntax, ctx), n in sorted(
+					pushes.items(),
+					key=lambda x:x[1],
+					reverse=True
+				)
+			],
+			"branch_rollbacks": self.branch_rollbacks,
+			"color_cache_hits": self.color_cache_hits,
+			"color_cache_misses": self.color_cache_misses,
+		}
+
+	def report(self, out=sys.stderr, limit:int=30):
+		stats = self.stats()
+		actions = stats["actions"]
+		total_ns = sum(map(lambda x:x["time_ns"], actions)) or 1
+		out.write(f"{'time ms':>10} {'%':>6} {'attempts':>10} {'hits':>10} {'misses':>10}  syntax / context / action: pattern\n")
+		for a in actions[:limit]:
+			pattern = " ".join(a["pattern"].split())
+			pattern = pattern if len(pattern) <= 60 else pattern[:57] + "..."
+			out.write(f"{a['time_ns'] / 1e6:>10.2f} {a['time_ns'] * 100 / total_ns:>6.2f} {a['attempts']:>10} {a['hits']:>10} {a['misses']:>10}  {a['syntax']} / {a['context']} / {a['action']}: {pattern}\n")
+		out.write(f"{'pushes':>10} {'pops':>10}  syntax / context\n")
+		for c in stats["contexts"][:limit]:
+			out.write(f"{c['pushes']:>10} {c['pops']:>10}  {c['syntax']} / {c['context']}\n")
+		out.write(f"match attempts: {sum(map(lambda x:x['attempts'], actions))} regex time: {total_ns / 1e6:.2f} ms\n")
+		out.write(f"branch rollbacks: {stats['branch_rollbacks']}\n")
+		out.write(f"color cache hits: {stats['color_cache_hits']} misses: {stats['color_cache_misses']}\n")
@@ -0,0 +1,156 @@
+import html
+from math import (
+	floor,
+	ceil,
+)
+from scsast import scopename
+from scsvec import rulescorer
+from sublcolorsys import (
+	rgba_to_ansi256,
+	hlsa_to_rgba,
+	rgba_to_hlsa,
+	hlsa_lerp,
+	term_color,
+)
+
+
+dbg = None
+
+
+# SyntaxHighlighter emits a stream of events: plain strings to write as they are, and
+# (scopestack, token) tuples where the color changes. Renderers turn them into output for
+# one color scheme, so a tokenization can be rendered with several schemes.
+
+
+def csscolor(rgba:tuple):
+	r, g, b, a = rgba
+	if a >= 1:
+		return f"#{int(round(r*255)):02x}{int(round(g*255)):02x}{int(round(b*255)):02x}"
+	return f"rgba({int(round(r*255))},{int(round(g*255))},{int(round(b*255))},{a:.3g})"
+
+
+class AnsiRenderer:
+
+	# scheme keys holding colors in this renderer's format, see parsecolorscheme()
+	foreground_key = "foreground_ansi256"
+	background_key = "background_ansi256"
+
+	def __init__(self, color_scheme:dict, profiler=None, scorer:str="auto"):
+		self.color_scheme = color_scheme
+		self.rule_scorer = rulescorer(color_scheme["rules"], scorer)
+		self.profiler = profiler
+		self.escape_cache = {}
+
+	def fromrgba(self, rgba:tuple):
+		return rgba_to_ansi256(*rgba)
+
+	def color_escape(self, foreground, background):
+		return term_color(foreground, background)
+
+	def token_color(self, scopestack:tuple, token:str):
+		_globals = self.color_scheme["globals"]
+		foreground_key = self.foreground_key
+		background_key = self.background_key
+		if dbg: dbg(f"token_color: token: {repr(token)} ss: {list(map(scopename, scopestack))}")
+		best = self.rule_scorer.best(scopestack)
+		if best is not None:
+			foreground = best.get("foreground", _globals["foreground"])
+			if dbg: dbg(f"token_color: token: {repr(token)} best rule: {best} has gradient: {'yes' if isinstance(foreground, list) else 'no'}")
+			if isinstance(foreground, list):
+				color_t = hash(token) % 255 / 255 if token else 0.0
+				samp_t = color_t * len(foreground) - color_t
+				foreground = hlsa_to_rgba(
+					*hlsa_lerp(
+						rgba_to_hlsa(*foreground[int(floor(samp_t))]),
+						rgba_to_hlsa(*foreground[int(ceil(samp_t))]),
+						color_t
+					)
+				)
+				if dbg: dbg(f"token_color: token: {repr(token)} color_t: {color_t} samp_t: {samp_t} color: {foreground}")
+				foreground = self.fromrgba(foreground)
+			else:
+				foreground = best.get(foreground_key, _globals[foreground_key])
+			return (
+				foreground,
+				best.get(background_key, _globals[background_key])
+			)
+		if dbg: dbg(f"no matching rule for token: {repr(token)}")
+		return _globals[foreground_key], _globals[background_key]
+
+	def escape(self, event:tuple):
+		escape = self.escape_cache.get(event, None)
+		if escape is None:
+			if self.profiler: self.profiler.color_cache_misses += 1
+			escape = self.escape_cache[event] = self.color_escape(*self.token_color(*event))
+		elif self.profiler:
+			self.profiler.color_cache_hits += 1
+		return escape
+
+	def render(self, events:list, out):
+		escape_cache = self.escape_cache
+		parts = []
+		for event in events:
+			if event.__class__ is str:
+				parts.append(event)
+			else:
+				escape = escape_cache.get(event, None) if not self.profiler else None
+				parts.append(escape if escape is not None else self.escape(event))
+		out.write("".join(parts))
+
+	def begin(self, out):
+		pass
+
+	def end(self, out):
+		pass
+
+
+class HtmlRenderer(AnsiRenderer):
+
+	# a <pre> in the scheme's default colors, a <span> per color change
+	foreground_key = "foreground"
+	background_key = "background"
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		# escape of the span that will be opened before the next text, of the one open
+		self.pending = None
+		self.current = "</span><span>"
+
+	def fromrgba(self, rgba:tuple):
+		return rgba
+
+	def color_escape(self, foreground, background):
+		_globals = self.color_scheme["globals"]
+		style = []
+		if foreground != _globals["foreground"]:
+			style.append(f"color:{csscolor(foreground)}")
+		if background != _globals["background"]:
+			style.append(f"background-color:{csscolor(background)}")
+		if not style:
+			return "</span><span>"
+		return f"</span><span style=\"{';'.join(style)}\">"
+
+	def render(self, events:list, out):
+		# color changes with no text in between would only leave empty spans
+		escape_cache = self.escape_cache
+		parts = []
+		for event in events:
+			if event.__class__ is str:
+				if event:
+					if self.pending is not None:
+						if self.pending != self.current:
+							parts.append(self.pending)
+							self.current = self.pending
+						self.pending = None
+					parts.append(html.escape(event, quote=False))
+			else:
+				escape = escape_cache.get(event, None) if not self.profiler else None
+				self.pending = escape if escape is not None else self.escape(event)
+		out.write("".join(parts))
+
+	def begin(self, out):
+		_globals = self.color_scheme["globals"]
+		out.write(f"<pre style=\"color:{csscolor(_globals['foreground'])};background-color:{csscolor(_globals['background'])}\"><span>")
+
+	def end(self, out):
+		out.write("</span></pre>\n")
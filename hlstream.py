@@ -0,0 +1,471 @@
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from collections import deque
+from scsast import (
+	atom,
+	atom_names,
+)
+
+
+# Scope stream: the tokenizer events (see hlrender) of every line, to render later with any
+# color scheme. Integers are LEB128 varints, strings are varint length + utf-8.
+#
+#   header   magic "SHLS", version byte
+#   chunks   kind byte, varint payload length, payload
+#     "D"    new definitions: atom count, atom names (ids are given in order of appearance,
+#            from 0), stack count, stacks as (parent stack id, atom count, atom ids); stack
+#            ids start from 1, 0 is the empty stack
+#     "L"    lines, zlib compressed: count, then per line the color in effect at its start (0 if none, else
+#            (stack id + 1) << 1 | has token, token) followed by event count and events:
+#            text (bytes << 2 | 0, bytes), color (stack << 2 | 1), color for the token in the
+#            next text event (stack << 2 | 2), color with its own token (stack << 2 | 3, token)
+#     "I"    index, last chunk: all definitions as in "D", line count, then (first line,
+#            offset) of every "L" chunk
+#   trailer  uint64 offset of the "I" chunk, magic "SHLI"
+#
+# Atoms and stacks are defined before the first line using them, so the stream can be decoded
+# front to back while it's being written, and the index lets a reader jump to a line range.
+
+magic = b"SHLS"
+index_magic = b"SHLI"
+version = 1
+trailer = struct.Struct("<Q4s")
+lines_per_chunk = 64
+
+
+def putvarint(buf:bytearray, n:int):
+	while n > 0x7f:
+		buf.append((n & 0x7f) | 0x80)
+		n >>= 7
+	buf.append(n)
+
+
+def putstr(buf:bytearray, s:str):
+	data = s.encode("utf-8", "surrogatepass")
+	putvarint(buf, len(data))
+	buf += data
+
+
+def getvarint(data:bytes, pos:int):
+	n = 0
+	shift = 0
+	while True:
+		b = data[pos]
+		pos += 1
+		n |= (b & 0x7f) << shift
+		if b < 0x80:
+			return n, pos
+		shift += 7
+
+
+def getstr(data:bytes, pos:int):
+	n, pos = getvarint(data, pos)
+	return data[pos:pos + n].decode("utf-8", "surrogatepass"), pos + n
+
+
+def putdefs(buf:bytearray, atoms:list, stacks:list):
+	putvarint(buf, len(atoms))
+	for name in atoms:
+		putstr(buf, name)
+	putvarint(buf, len(stacks))
+	for parent, atom_ids in stacks:
+		putvarint(buf, parent)
+		putvarint(buf, len(atom_ids))
+		for a in atom_ids:
+			putvarint(buf, a)
+
+
+class ScopeStreamWriter:
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.offset = 0
+		self.atom_ids = {}
+		self.atoms = []
+		self.stack_ids = {(): 0}
+		self.stacks = []
+		# atoms and stacks already written
+		self.atoms_done = 0
+		self.stacks_done = 0
+		self.lines = []
+		self.nlines = 0
+		self.index = []
+		# last color event written, to restart rendering at any line
+		self.color = None
+		self.write(magic + bytes((version,)))
+
+	def write(self, data:bytes):
+		self.stream.write(data)
+		self.offset += len(data)
+
+	def chunk(self, kind:bytes, payload:bytearray):
+		head = bytearray(kind)
+		putvarint(head, len(payload))
+		self.write(bytes(head + payload))
+
+	def atomid(self, a:int):
+		i = self.atom_ids.get(a, None)
+		if i is None:
+			i = self.atom_ids[a] = len(self.atoms)
+			self.atoms.append(atom_names[a])
+		return i
+
+	def stackid(self, stack:tuple):
+		i = self.stack_ids.get(stack, None)
+		if i is None:
+			parent = self.stackid(stack[:-1])
+			self.stacks.append((parent, tuple(map(self.atomid, stack[-1]))))
+			i = self.stack_ids[stack] = len(self.stacks)
+		return i
+
+	def line(self, events:list):
+		buf = bytearray()
+		color = self.color
+		if color is None:
+			putvarint(buf, 0)
+		else:
+			putvarint(buf, (self.stackid(color[0]) + 1) << 1 | (color[1] is not None))
+			if color[1] is not None:
+				putstr(buf, color[1])
+		putvarint(buf, len(events))
+		n = len(events)
+		for i, event in enumerate(events):
+			if event.__class__ is str:
+				data = event.encode("utf-8", "surrogatepass")
+				putvarint(buf, len(data) << 2)
+				buf += data
+				continue
+			stack, token = event
+			stack = self.stackid(stack)
+			if token is None:
+				putvarint(buf, stack << 2 | 1)
+			elif i + 1 < n and events[i + 1] == token:
+				# write_token(): the token is the text that follows
+				putvarint(buf, stack << 2 | 2)
+			else:
+				putvarint(buf, stack << 2 | 3)
+				putstr(buf, token)
+			self.color = event
+		self.lines.append(buf)
+		if len(self.lines) >= lines_per_chunk:
+			self.flush()
+
+	def flush(self):
+		if self.lines:
+			if self.atoms_done < len(self.atoms) or self.stacks_done < len(self.stacks):
+				buf = bytearray()
+				putdefs(buf, self.atoms[self.atoms_done:], self.stacks[self.stacks_done:])
+				self.chunk(b"D", buf)
+				self.atoms_done = len(self.atoms)
+				self.stacks_done = len(self.stacks)
+			self.index.append((self.nlines, self.offset))
+			buf = bytearray()
+			putvarint(buf, len(self.lines))
+			for line in self.lines:
+				buf += line
+			self.nlines += len(self.lines)
+			self.lines.clear()
+			self.chunk(b"L", zlib.compress(buf))
+		self.stream.flush()
+
+	def close(self):
+		self.flush()
+		buf = bytearray()
+		putdefs(buf, self.atoms, self.stacks)
+		putvarint(buf, self.nlines)
+		putvarint(buf, len(self.index))
+		for first_line, offset in self.index:
+			putvarint(buf, first_line)
+			putvarint(buf, offset)
+		index_offset = self.offset
+		self.chunk(b"I", buf)
+		self.write(trailer.pack(index_offset, index_magic))
+		self.stream.flush()
+
+
+class ScopeStreamReader:
+
+	def __init__(self, stream):
+		self.stream = stream
+		if stream.read(len(magic)) != magic:
+			raise ValueError("not a scope stream")
+		v = stream.read(1)
+		if not v or v[0] != version:
+			raise ValueError(f"unsupported scope stream version: {v[0] if v else None}")
+		self.atoms = []
+		self.stacks = [()]
+		self.index = None
+		self.nlines = None
+
+	def getdefs(self, data:bytes, pos:int):
+		n, pos = getvarint(data, pos)
+		for i in range(n):
+			name, pos = getstr(data, pos)
+			# to this process' atom ids
+			self.atoms.append(atom(name))
+		atoms = self.atoms
+		stacks = self.stacks
+		n, pos = getvarint(data, pos)
+		for i in range(n):
+			parent, pos = getvarint(data, pos)
+			count, pos = getvarint(data, pos)
+			scope = []
+			for j in range(count):
+				a, pos = getvarint(data, pos)
+				scope.append(atoms[a])
+			stacks.append(stacks[parent] + (tuple(scope),))
+		return pos
+
+	def readchunk(self):
+		kind = self.stream.read(1)
+		if not kind:
+			return None, None
+		head = bytearray()
+		while True:
+			b = self.stream.read(1)
+			if not b:
+				raise ValueError("truncated scope stream")
+			head += b
+			if b[0] < 0x80:
+				break
+		n, _ = getvarint(head, 0)
+		payload = self.stream.read(n)
+		if len(payload) != n:
+			raise ValueError("truncated scope stream")
+		return kind, payload
+
+	def getlines(self, data:bytes, first:int, start:int, stop):
+		# lines of an "L" chunk starting at line number first, as lists of events
+		n, pos = getvarint(data, 0)
+		stacks = self.stacks
+		for i in range(first, first + n):
+			if stop is not None and i >= stop:
+				return
+			head, pos = getvarint(data, pos)
+			events = []
+			if head:
+				token = None
+				if head & 1:
+					token, pos = getstr(data, pos)
+				if i == start:
+					# rendering starts here, restore the color the previous lines left
+					events.append((stacks[(head >> 1) - 1], token))
+			count, pos = getvarint(data, pos)
+			j = 0
+			while j < count:
+				code, pos = getvarint(data, pos)
+				kind = code & 3
+				j += 1
+				if not kind:
+					end = pos + (code >> 2)
+					events.append(data[pos:end].decode("utf-8", "surrogatepass"))
+					pos = end
+				elif kind == 1:
+					events.append((stacks[code >> 2], None))
+				elif kind == 2:
+					text_code, pos = getvarint(data, pos)
+					end = pos + (text_code >> 2)
+					text = data[pos:end].decode("utf-8", "surrogatepass")
+					pos = end
+					j += 1
+					events.append((stacks[code >> 2], text))
+					events.append(text)
+				else:
+					token, pos = getstr(data, pos)
+					events.append((stacks[code >> 2], token))
+			if i >= start:
+				yield events
+
+	def loadindex(self):
+		# -> True if the stream is complete and seekable, then all atoms and stacks are known
+		stream = self.stream
+		try:
+			here = stream.tell()
+			stream.seek(-trailer.size, os.SEEK_END)
+			index_offset, m = trailer.unpack(stream.read(trailer.size))
+			if m != index_magic:
+				stream.seek(here)
+				return False
+			stream.seek(index_offset)
+		except (OSError, ValueError, struct.error):
+			return False
+		kind, payload = self.readchunk()
+		if kind != b"I":
+			raise ValueError("corrupt scope stream index")
+		pos = self.getdefs(payload, 0)
+		self.nlines, pos = getvarint(payload, pos)
+		n, pos = getvarint(payload, pos)
+		self.index = []
+		for i in range(n):
+			first_line, pos = getvarint(payload, pos)
+			offset, pos = getvarint(payload, pos)
+			self.index.append((first_line, offset))
+		return True
+
+	def lines(self, start:int=0, stop:int=None):
+		# event lists of lines [start, stop), jumping to start through the index if there's one
+		first = 0
+		indexed = start > 0 and self.loadindex()
+		if indexed:
+			i = bisect_right(list(map(lambda x:x[0], self.index)), start) - 1
+			if i < 0:
+				return
+			first, offset = self.index[i]
+			self.stream.seek(offset)
+		while stop is None or first < stop:
+			kind, payload = self.readchunk()
+			if kind is None or kind == b"I":
+				return
+			if kind == b"D":
+				if not indexed:
+					self.getdefs(payload, 0)
+				continue
+			if kind != b"L":
+				raise ValueError(f"unknown scope stream chunk: {kind}")
+			payload = zlib.decompress(payload)
+			n, _ = getvarint(payload, 0)
+			if first + n > start:
+				yield from self.getlines(payload, first, start, stop)
+			first += n
+
+
+def parselinerange(spec:str):
+	# "A:B", "A:" or "A", 1-based and inclusive -> 0-based [start, stop)
+	first, sep, last = spec.partition(":")
+	start = int(first) - 1 if first else 0
+	stop = (int(last) if last else None) if sep else start + 1
+	if start < 0 or (stop is not None and stop <= start):
+		raise ValueError(f"invalid line range: {spec}")
+	return start, stop
+
+
+def linetext(events:list):
+	return "".join(filter(lambda x:x.__class__ is str, events))
+
+
+class LineSplitter:
+
+	# groups the events SyntaxHighlighter writes into the lines their text belongs to: while a
+	# branch is pending its events are held back, and come out with the line it resolves on
+
+	def __init__(self):
+		self.current = []
+
+	def split(self, events:list):
+		# -> event lists of the lines the events complete, color changes after a line ending
+		# go to the next line
+		lines = []
+		current = self.current
+		for event in events:
+			if event.__class__ is not str:
+				current.append(event)
+				continue
+			while event:
+				i = event.find("\n") + 1
+				if not i:
+					current.append(event)
+					break
+				current.append(event[:i])
+				lines.append(current)
+				current = []
+				event = event[i:]
+		self.current = current
+		return lines
+
+	def end(self):
+		# -> events after the last line ending: the last line if the input doesn't end with one,
+		# or only color changes
+		current = self.current
+		self.current = []
+		return current
+
+
+class LineRange:
+
+	# passes on the events of lines [start, stop), the first one with the color the previous lines left
+
+	def __init__(self, start:int, stop:int=None):
+		self.start = start
+		self.stop = stop
+		self.line = 0
+		self.color = None
+
+	def select(self, events:list):
+		line = self.line
+		self.line += 1
+		if line < self.start:
+			for event in reversed(events):
+				if event.__class__ is tuple:
+					self.color = event
+					break
+			return None
+		if self.stop is not None and line >= self.stop:
+			return None
+		if line == self.start and self.color:
+			return [self.color] + events
+		return events
+
+
+class GrepFilter:
+
+	# passes on the events of the lines whose text matches, with before and after context lines;
+	# groups of lines not following the last one passed start with the color the previous lines
+	# left and, if there's context, a -- line
+
+	def __init__(self, pattern, before:int=0, after:int=0):
+		self.pattern = pattern
+		self.after = after
+		self.separate = before > 0 or after > 0
+		# (color at its start, events) of the last lines skipped
+		self.held = deque(maxlen=before) if before else None
+		self.remaining = 0
+		self.line = 0
+		self.last = None
+		self.color = None
+
+	def wants(self, text:str):
+		# -> whether the events of the next line, with this text, may be written
+		return self.held is not None or self.remaining > 0 or self.pattern.search(text) is not None
+
+	def skip(self, *event_lists):
+		# instead of select() for a line wants() said no to: only the color its events leave
+		self.line += 1
+		for events in reversed(event_lists):
+			for event in reversed(events):
+				if event.__class__ is tuple:
+					self.color = event
+					return
+
+	def select(self, text:str, events:list):
+		line = self.line
+		self.line += 1
+		color = self.color
+		for event in reversed(events):
+			if event.__class__ is tuple:
+				self.color = event
+				break
+		if self.pattern.search(text):
+			self.remaining = self.after
+		elif self.remaining:
+			self.remaining -= 1
+		else:
+			if self.held is not None:
+				self.held.append((color, list(events)))
+			return None
+		lines = []
+		if self.held:
+			lines.extend(self.held)
+			self.held.clear()
+		lines.append((color, events))
+		selected = []
+		if self.last is None or line - len(lines) != self.last:
+			if self.separate and self.last is not None:
+				selected.extend((((), None), "--\n"))
+			if lines[0][0]:
+				selected.append(lines[0][0])
+		for _, line_events in lines:
+			selected.extend(line_events)
+		self.last = line
+		return selected
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# runs Sublime Text syntax tests (syntax_test_* files) against the scopes SyntaxHighlighter gives
+
+import argparse
+import os
+import re
+import sys
+from multiprocessing import Pool
+from hl import (
+	Grammar,
+	SyntaxHighlighter,
+)
+from scsast import (
+	atomize,
+	scopename,
+)
+from sublsyntax import (
+	loadsyntax,
+	parsesyntax,
+	syntax_dir_path,
+)
+
+
+# A test file starts with a comment naming the syntax:
+#   // SYNTAX TEST "Packages/C++/C++.sublime-syntax"
+# then every line starting with the same comment token is an assertion on the closest line
+# above that isn't one:
+#   //   ^^^^ storage.type      the columns of the carets match the selector
+#   // <- comment               the column of the comment token does
+# Selectors are scope paths ("source.c meta.function") combined with | or , (or), & (and),
+# - (and not, or not at the start) and parentheses.
+
+re_header = re.compile(r"^\s*(\S+)\s+SYNTAX TEST\s+(?:[\w-]+\s+)*\"([^\"]+)\"(?:\s+(\S+))?")
+re_selector_token = re.compile(r"\s*(?:([(),|&-])|([^\s(),|&]+))")
+
+
+def testfiles(paths:list):
+	for path in paths:
+		if os.path.isdir(path):
+			for dirpath, dirnames, filenames in os.walk(path):
+				dirnames.sort()
+				for filename in sorted(filenames):
+					if filename.startswith("syntax_test_"):
+						yield os.path.join(dirpath, filename)
+		else:
+			yield path
+
+
+def parseselector(selector:str):
+	tokens = []
+	pos = 0
+	selector = selector.strip()
+	while pos < len(selector):
+		m = re_selector_token.match(selector, pos)
+		if not m or m.end() == pos:
+			raise ValueError(f"invalid selector: {selector}")
+		tokens.append(m.group(1) or ("scope", atomize(m.group(2))))
+		pos = m.end()
+	tokens.append(None)
+	xp, i = parseor(tokens, 0)
+	if tokens[i] is not None:
+		raise ValueError(f"invalid selector: {selector}")
+	return xp
+
+
+def parseor(tokens:list, i:int):
+	xps = []
+	while True:
+		xp, i = parseand(tokens, i)
+		xps.append(xp)
+		if tokens[i] not in ("|", ","):
+			return (("or", xps) if len(xps) > 1 else xp), i
+		i += 1
+
+
+def parseand(tokens:list, i:int):
+	xp, i = parsenot(tokens, i)
+	while tokens[i] in ("&", "-"):
+		op = tokens[i]
+		rhs, i = parsenot(tokens, i + 1)
+		xp = ("and", [xp, rhs if op == "&" else ("not", rhs)])
+	return xp, i
+
+
+def parsenot(tokens:list, i:int):
+	t = tokens[i]
+	if t == "-":
+		xp, i = parsenot(tokens, i + 1)
+		return ("not", xp), i
+	if t == "(":
+		xp, i = parseor(tokens, i + 1)
+		if tokens[i] != ")":
+			raise ValueError("unbalanced parens in selector")
+		return xp, i + 1
+	path = []
+	while tokens[i].__class__ is tuple:
+		path.append(tokens[i][1])
+		i += 1
+	if not path:
+		raise ValueError(f"expecting a scope in selector, got: {t}")
+	return ("path", tuple(path)), i
+
+
+def selectormatches(xp, scopestack:tuple):
+	op, arg = xp
+	if op == "path":
+		# each scope of the path, in order, prefixes some scope of the stack
+		j = 0
+		for scope in scopestack:
+			if scope[:len(arg[j])] == arg[j]:
+				j += 1
+				if j == len(arg):
+					return True
+		return False
+	if op == "not":
+		return not selectormatches(arg, scopestack)
+	if op == "and":
+		return all(map(lambda x:selectormatches(x, scopestack), arg))
+	return any(map(lambda x:selectormatches(x, scopestack), arg))
+
+
+def highlight(syntax_path:str, lines:list):
+	# -> scope stack of every character of lines
+	events = []
+	shl = SyntaxHighlighter(Grammar(parsesyntax(loadsyntax(syntax_path))), events)
+	shl.begin()
+	for line in lines:
+		shl.process(line)
+	shl.end()
+	scopes = []
+	scopestack = ()
+	for event in events:
+		if event.__class__ is str:
+			scopes.extend((scopestack,) * len(event))
+		else:
+			scopestack = event[0]
+	return scopes
+
+
+def runtest(path:str):
+	# -> (path, [(line number, columns, selector, failures: [(column, scopes or None)])], error)
+	try:
+		with open(path, "r", encoding="utf-8") as f:
+			lines = f.readlines()
+		header = re_header.match(lines[0]) if lines else None
+		if not header:
+			return path, [], "no SYNTAX TEST header"
+		token, syntax_ref, end_token = header.groups()
+		syntax_path = os.path.join(syntax_dir_path, os.path.basename(syntax_ref))
+		if not os.path.isfile(syntax_path):
+			return path, [], f"syntax not found: {syntax_ref}"
+		re_assertion = re.compile(rf"^(\s*){re.escape(token)}(\s*)(?:(<-)|(\^+)|(@+))(.*)$")
+		scopes = highlight(syntax_path, lines)
+		if len(scopes) != sum(map(len, lines)):
+			return path, [], "highlighted text differs from the file"
+		results = []
+		offset = 0
+		target = None
+		for lineno, line in enumerate(lines):
+			m = re_assertion.match(line.rstrip("\n")) if lineno else None
+			if not m:
+				target = (offset, line.rstrip("\n"))
+				offset += len(line)
+				continue
+			offset += len(line)
+			if m.group(5) or target is None:
+				# symbol assertions (@@@) are about the index, not scopes
+				continue
+			selector = m.group(6)
+			if end_token and selector.rstrip().endswith(end_token):
+				selector = selector.rstrip()[:-len(end_token)]
+			selector = selector.strip()
+			if m.group(3):
+				columns = [len(m.group(1))]
+			else:
+				start = m.start(4)
+				columns = list(range(start, m.end(4)))
+			xp = parseselector(selector)
+			target_offset, target_line = target
+			failures = []
+			for col in columns:
+				if col > len(target_line):
+					failures.append((col, None))
+				elif not selectormatches(xp, scopes[target_offset + col]):
+					failures.append((col, " ".join(map(scopename, scopes[target_offset + col]))))
+			results.append((lineno, columns, selector, failures))
+		return path, results, None
+	except Exception as e:
+		return path, [], f"{e.__class__.__name__}: {e}"
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-j", "--jobs", type=int, help="test files run in parallel, default: one per cpu", default=None)
+	parser.add_argument("-v", "--verbose", action="store_true", help="also report the assertions that pass", default=False)
+	parser.add_argument("paths", nargs="+", type=str, help="syntax_test_* files, or directories to search for them")
+	args = parser.parse_args()
+	paths = list(testfiles(args.paths))
+	nfiles = nassertions = nfailed = nerrors = 0
+	if args.jobs == 1 or len(paths) <= 1:
+		pool = None
+		results = map(runtest, paths)
+	else:
+		pool = Pool(args.jobs)
+		results = pool.imap(runtest, paths)
+	for path, assertions, error in results:
+		nfiles += 1
+		if error:
+			nerrors += 1
+			print(f"{path}: error: {error}")
+			continue
+		for lineno, columns, selector, failures in assertions:
+			nassertions += 1
+			if failures:
+				nfailed += 1
+				for col, scopes in failures:
+					print(f"{path}:{lineno + 1}:{col + 1}: FAIL expected: {selector}")
+					print(f"    got: {scopes if scopes is not None else '(past the end of the line)'}")
+			elif args.verbose:
+				print(f"{path}:{lineno + 1}:{columns[0] + 1}: pass: {selector}")
+	if pool is not None:
+		pool.close()
+		pool.join()
+	print(f"{nfiles} files, {nassertions} assertions, {nfailed} failed, {nerrors} files with errors")
+	sys.exit(1 if nfailed or nerrors else 0)
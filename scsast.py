@@ -1,4 +1,5 @@
 import regex as re
+import threading
 
 
 re_token_patt = re.compile(r"([a-zA-Z0-9_\-.]+|\,|\|| - |\(|\))")
@@ -6,6 +7,43 @@ OP_OR = "|"
 OP_XCL = " - "
 OP_INCL = ","
 OPERATORS = (OP_OR, OP_XCL, OP_INCL)
+# scope atoms ("source", "python", ...) are interned as small ints, shared by selectors and scope stacks
+atom_ids = {}
+atom_names = []
+scope_atoms = {}
+atom_lock = threading.Lock()
+
+
+def atom(name:str):
+	i = atom_ids.get(name, None)
+	if i is None:
+		# highlighters in other threads must not give the same name another id
+		with atom_lock:
+			i = atom_ids.get(name, None)
+			if i is None:
+				atom_names.append(name)
+				i = atom_ids[name] = len(atom_names) - 1
+	return i
+
+
+def atomize(scope:str):
+	atoms = scope_atoms.get(scope, None)
+	if atoms is None:
+		atoms = scope_atoms[scope] = tuple(map(atom, scope.split(".")))
+	return atoms
+
+
+def scopename(atoms:tuple):
+	return ".".join(map(atom_names.__getitem__, atoms))
+
+
+def mapxp(xp, f):
+	# apply f to every scope (tuple of atoms) of a parsed selector
+	if isinstance(xp, tuple) and len(xp) == 2 and isinstance(xp[0], str):
+		return (xp[0], mapxp(xp[1], f))
+	if isinstance(xp, list):
+		return list(map(lambda x:mapxp(x, f), xp))
+	return f(xp)
 
 
 def __opgroup(expr, op):
@@ -42,7 +80,7 @@ def __splittags(expr):
 	elif isinstance(expr, list):
 		for i in range(len(expr)):
 			if isinstance(expr[i], str):
-				expr[i] = expr[i].split(".")
+				expr[i] = atomize(expr[i])
 			else:
 				__splittags(expr[i])
 
@@ -85,7 +123,7 @@ def scorescope(scopedef, scopestack, ss_len):
 		j = 0
 		while j < sd_len:
 			sstags = scopestack[i+j]
-			tags = scopedef[j]#.split(".")
+			tags = scopedef[j]
 			for a, b in zip(sstags, tags):
 				if a != b:
 					score = 0
@@ -120,10 +158,28 @@ def scorexp(xp, scopestack, ss_len):
 	return scorescope(xp, scopestack, ss_len)
 
 
+class RuleScorer:
+
+	def __init__(self, rules:list):
+		self.rules = rules
+
+	def best(self, scopestack:tuple):
+		# first rule with the highest score, None if none scores
+		best = None
+		best_score = 0
+		lenss = len(scopestack)
+		for rule in self.rules:
+			score = scorexp(rule["scope"], scopestack, lenss)
+			if score > 0 and (best is None or score > best_score):
+				best = rule
+				best_score = score
+		return best
+
+
 if __name__ == "__main__":
 	import sys
 	rulescope = parserulescope(sys.argv[1])
 	print("rulescope", rulescope)
-	ss = [['source', 'python'], ['keyword', 'control', 'import', 'python']]
+	ss = (atomize("source.python"), atomize("keyword.control.import.python"))
 	print("ss", ss)
 	print("scorexp", scorexp(rulescope, ss, len(ss)))
\ No newline at end of file
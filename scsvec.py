@@ -0,0 +1,195 @@
+from scsast import (
+	OP_OR,
+	OP_XCL,
+	OP_INCL,
+	RuleScorer,
+)
+
+
+scorer_engines = ("auto", "python", "numpy")
+# below this many rules the per-call numpy overhead isn't worth it
+auto_min_rules = 16
+# numpy takes a while to import, auto only switches to it once the color cache keeps missing
+auto_switch_calls = 256
+np = None
+
+
+def loadnumpy():
+	global np
+	if np is None:
+		try:
+			import numpy
+		except ImportError:
+			np = False
+		else:
+			np = numpy
+	return np
+
+
+class VectorRuleScorer:
+
+	# Same result as scsast.RuleScorer, computed for all rules at once. Each scope sequence
+	# of every selector becomes a row of part ids, a scope stack becomes a (stack element,
+	# part) matrix of per-part scores, and every window of every row is scored with a
+	# single fancy-indexing gather. Selector operators are then folded bottom up, one
+	# numpy reduction per tree level.
+
+	def __init__(self, rules:list):
+		self.rules = rules
+		self.part_ids = {}
+		self.seq_ids = {}
+		self.seqs = []
+		self.nodes = []
+		self.roots = np.array(list(map(lambda x:self.node(x["scope"]), rules)), dtype=np.intp)
+		nparts = len(self.part_ids)
+		# prefix -> part equal to it; prefix -> parts it's a proper prefix of
+		self.exact = {}
+		longer = {}
+		for part, pid in self.part_ids.items():
+			if part is None:
+				continue
+			self.exact[part] = pid
+			for k in range(1, len(part)):
+				longer.setdefault(part[:k], []).append(pid)
+		self.longer = longer
+		self.width = max(map(len, self.seqs), default=0) or 1
+		# part id nparts is padding, its column stays 0
+		self.seq_parts = np.full((len(self.seqs), self.width), nparts, dtype=np.intp)
+		for i, seq in enumerate(self.seqs):
+			self.seq_parts[i, :len(seq)] = seq
+		self.seq_used = self.seq_parts != nparts
+		self.nparts = nparts
+		self.levels = self.compilelevels()
+		self.element_scores = {}
+
+	def node(self, xp):
+		if isinstance(xp, tuple):
+			op, subxp = xp
+			children = list(map(self.node, subxp))
+			if op == OP_XCL and len(children) > 1:
+				kind = OP_XCL
+			elif op in (OP_OR, OP_INCL, OP_XCL):
+				kind = OP_OR
+			else:
+				raise ValueError(f"unknown selector operator: {op}")
+			self.nodes.append((kind, children))
+			return ~(len(self.nodes) - 1)
+		if not isinstance(xp, list):
+			raise ValueError(f"unsupported selector: {xp}")
+		# scsast never matches a nested (...) group inside a sequence, neither does the None part
+		xp = list(map(lambda x:x if isinstance(x, tuple) and all(map(lambda y:isinstance(y, int), x)) else None, xp))
+		seq = tuple(map(lambda x:self.part_ids.setdefault(x, len(self.part_ids)), xp))
+		if seq not in self.seq_ids:
+			self.seq_ids[seq] = len(self.seqs)
+			self.seqs.append(seq)
+		return self.seq_ids[seq]
+
+	def compilelevels(self):
+		# leaves (sequences) are values[0:nseqs], operator node i is values[nseqs + i]
+		nseqs = len(self.seqs)
+		self.roots = np.where(self.roots >= 0, self.roots, nseqs + ~self.roots)
+		heights = []
+		for kind, children in self.nodes:
+			heights.append(1 + max(map(lambda x:0 if x >= 0 else heights[~x], children)))
+		levels = []
+		for h in range(1, max(heights, default=0) + 1):
+			ors = []
+			xcls = []
+			for i, (kind, children) in enumerate(self.nodes):
+				if heights[i] == h:
+					children = list(map(lambda x:x if x >= 0 else nseqs + ~x, children))
+					(ors if kind == OP_OR else xcls).append((nseqs + i, children))
+			levels.append((self.reduction(ors), self.reduction(list(map(lambda x:(x[0], x[1][1:], x[1][0]), xcls)))))
+		return levels
+
+	@staticmethod
+	def reduction(items:list):
+		if not items:
+			return None
+		targets = np.array(list(map(lambda x:x[0], items)), dtype=np.intp)
+		children = np.array([c for x in items for c in x[1]], dtype=np.intp)
+		offsets = np.cumsum([0] + list(map(lambda x:len(x[1]), items[:-1])), dtype=np.intp)
+		mains = np.array(list(map(lambda x:x[2], items)), dtype=np.intp) if len(items[0]) > 2 else None
+		return targets, children, offsets, mains
+
+	def elementscores(self, tags:tuple):
+		# part ids matching a scope stack element, and their scores
+		entry = self.element_scores.get(tags, None)
+		if entry is None:
+			ids = []
+			scores = []
+			for k in range(1, len(tags) + 1):
+				pid = self.exact.get(tags[:k], None)
+				if pid is not None:
+					ids.append(pid)
+					scores.append(k)
+			for pid in self.longer.get(tags, ()):
+				ids.append(pid)
+				scores.append(len(tags))
+			entry = self.element_scores[tags] = (np.array(ids, dtype=np.intp), np.array(scores, dtype=np.int32))
+		return entry
+
+	def scores(self, scopestack:tuple):
+		lenss = len(scopestack)
+		width = self.width
+		part_scores = np.zeros((lenss + width, self.nparts + 1), dtype=np.int32)
+		for e, tags in enumerate(scopestack):
+			ids, scores = self.elementscores(tags)
+			part_scores[e, ids] = scores
+		rows = np.arange(lenss)[:, None] + np.arange(width)[None, :]
+		# (window start, sequence, part)
+		g = part_scores[rows[:, None, :], self.seq_parts[None, :, :]]
+		ok = ((g > 0) | ~self.seq_used[None, :, :]).all(axis=2)
+		seq_scores = (g.sum(axis=2) * ok).max(axis=0) if lenss else np.zeros(len(self.seqs), dtype=np.int32)
+		values = np.zeros(len(self.seqs) + len(self.nodes), dtype=np.int32)
+		values[:len(self.seqs)] = seq_scores
+		for ors, xcls in self.levels:
+			if ors is not None:
+				targets, children, offsets, _ = ors
+				values[targets] = np.maximum.reduceat(values[children], offsets)
+			if xcls is not None:
+				targets, children, offsets, mains = xcls
+				values[targets] = np.where(np.maximum.reduceat(values[children], offsets) > 0, 0, values[mains])
+		return values[self.roots]
+
+	def best(self, scopestack:tuple):
+		if not self.rules:
+			return None
+		scores = self.scores(scopestack)
+		i = int(scores.argmax())
+		return self.rules[i] if scores[i] > 0 else None
+
+
+class AutoRuleScorer(RuleScorer):
+
+	def __init__(self, rules:list):
+		super().__init__(rules)
+		self.calls = 0
+
+	def best(self, scopestack:tuple):
+		self.calls += 1
+		if self.calls >= auto_switch_calls:
+			scorer = vectorscorer(self.rules)
+			# stop counting either way
+			self.best = scorer.best if scorer else super().best
+		return super().best(scopestack)
+
+
+def vectorscorer(rules:list):
+	if not loadnumpy():
+		return None
+	try:
+		return VectorRuleScorer(rules)
+	except ValueError:
+		# selector shapes scsast can score but the vector engine doesn't know
+		return None
+
+
+def rulescorer(rules:list, engine:str="auto"):
+	if engine not in scorer_engines:
+		raise ValueError(f"unknown scorer engine: {engine}, expecting one of: {', '.join(scorer_engines)}")
+	if engine == "numpy":
+		return vectorscorer(rules) or RuleScorer(rules)
+	if engine == "auto" and len(rules) >= auto_min_rules:
+		return AutoRuleScorer(rules)
+	return RuleScorer(rules)
@@ -1,10 +1,12 @@
+import hashlib
 import os
+import pickle
 import re
 import yaml
-import tinycss2
-import tinycss2.color3
 from colorsys import hls_to_rgb, rgb_to_hls
+import scsast
 from scsast import parserulescope
+from sublcolorsys import rgba_to_ansi256
 
 
 file_ext = "sublime-color-scheme"
@@ -18,6 +20,12 @@ all_color_schemes_basenames = list(
 		os.listdir(color_scheme_dir_path)
 	)
 )
+cache_dir_path = os.path.join(
+	os.environ.get("XDG_CACHE_HOME", None) or os.path.join(os.path.expanduser("~"), ".cache"),
+	"sublhighlight"
+)
+# bump when the evaluated scheme layout changes
+cache_version = 2
 all_color_schemes_names = list(
 	map(
 		lambda x: os.path.splitext(x)[0],
@@ -53,7 +61,10 @@ yaml.SafeLoader.add_constructor(u'tag:yaml.org,2002:value', construct_value)
 
 def loadcolorscheme(path):
 	with open(path, "rb") as f:
-		content = f.read()
+		return loadcolorschemedata(f.read())
+
+
+def loadcolorschemedata(content:bytes):
 	# yes, json can be parsed as yaml with support for trailing commas!
 	# unfortunately yaml will not take // as a line comment...
 	try:
@@ -87,10 +98,68 @@ def parsecolorscheme(scheme):
 	except:
 		print(f"parsecolorscheme: {scheme['name']}")
 		raise
+	# plain tuples instead of tinycss2 RGBA so that the result can be unpickled without tinycss2
+	for name in _var:
+		_var[name] = plaincolor(_var[name])
+	for key in glob:
+		glob[key] = plaincolor(glob[key])
+	for rule in rules:
+		for key in ("foreground", "background"):
+			if key in rule:
+				rule[key] = plaincolor(rule[key])
+	for item in (glob, *rules):
+		for key in ("foreground", "background"):
+			if iscolor(item.get(key, None)):
+				item[f"{key}_ansi256"] = rgba_to_ansi256(*item[key])
+	return scheme
+
+
+def plaincolor(value):
+	if isinstance(value, list):
+		return list(map(plaincolor, value))
+	if isinstance(value, tuple):
+		return tuple(value)
+	return value
+
+
+def iscolor(value):
+	return isinstance(value, tuple) and len(value) == 4
+
+
+def loadparsedcolorscheme(path, cache=True):
+	# evaluated schemes are cached by content hash, a warm start doesn't need yaml parsing or tinycss2
+	with open(path, "rb") as f:
+		content = f.read()
+	if not cache:
+		return parsecolorscheme(loadcolorschemedata(content))
+	digest = hashlib.sha256(b"%d:" % cache_version + content).hexdigest()
+	cache_path = os.path.join(cache_dir_path, f"{digest}.{file_ext}.pickle")
+	try:
+		with open(cache_path, "rb") as f:
+			names, scheme = pickle.load(f)
+		# atom ids are per process, map the cached ones to ours
+		table = list(map(scsast.atom, names))
+		for rule in scheme["rules"]:
+			rule["scope"] = scsast.mapxp(rule["scope"], lambda x:tuple(map(table.__getitem__, x)))
+		return scheme
+	except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError, TypeError):
+		pass
+	scheme = parsecolorscheme(loadcolorschemedata(content))
+	try:
+		os.makedirs(cache_dir_path, exist_ok=True)
+		tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+		with open(tmp_path, "wb") as f:
+			pickle.dump((scsast.atom_names, scheme), f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, cache_path)
+	except OSError:
+		# read-only home and the like, the cache is just an optimization
+		pass
 	return scheme
 
 
 def evalexpr(_var, expr):
+	import tinycss2
+	import tinycss2.color3
 	def evalfunc(_var, compo):
 		args = list(filter(lambda x:x.type != "whitespace", compo.arguments))
 		if not args:
@@ -0,0 +1,501 @@
+import re
+import onigurumacffi as oniguruma
+
+
+# Patterns that are plain literals, alternations of literals with optional \b anchors, or a
+# single character class (optionally as a lookahead) are matched with str.startswith(), a set
+# lookup or an ascii membership test instead of an oniguruma call. Anything the classifier
+# doesn't fully understand goes to oniguruma, and so do the inputs where the answer depends on
+# non-ascii characters, so results are the same as with oniguruma alone.
+
+fastpath = True
+literal_metachars = frozenset(".^$|?*+()[]{}")
+literal_ctrl_escapes = {
+	"t": "\t",
+	"n": "\n",
+	"r": "\r",
+	"f": "\f",
+	"v": "\v",
+	"a": "\a",
+	"e": "\x1b",
+}
+re_asciiword = re.compile(r"[A-Za-z0-9_]*", re.ASCII)
+# compiled patterns by pattern string, process-wide, see compile()
+interned = {}
+
+
+def isasciiword(c:str):
+	return c.isascii() and (c.isalnum() or c == "_")
+
+
+def wordboundary(text:str, pos:int):
+	# True/False, or None when oniguruma's unicode notion of a word character would be needed
+	before = text[pos - 1] if pos > 0 else ""
+	after = text[pos] if pos < len(text) else ""
+	if not before.isascii() or not after.isascii():
+		return None
+	return (before != "" and isasciiword(before)) != (after != "" and isasciiword(after))
+
+
+def scanliteral(patt:str, i:int):
+	lit = []
+	n = len(patt)
+	while i < n:
+		c = patt[i]
+		if c == "\\":
+			if i + 1 >= n:
+				return None, i
+			d = patt[i + 1]
+			if d in literal_ctrl_escapes:
+				lit.append(literal_ctrl_escapes[d])
+			elif d.isascii() and not d.isalnum() and not d.isspace():
+				lit.append(d)
+			else:
+				break
+			i += 2
+		elif c in literal_metachars:
+			break
+		else:
+			lit.append(c)
+			i += 1
+	return "".join(lit), i
+
+
+def parseliterals(patt:str):
+	# [\b](?:lit|lit|...)[\b], [\b]lit[\b], or lit|lit|... => (lead_b, alternatives, trail_b, capture)
+	i = 0
+	n = len(patt)
+	lead_b = patt.startswith("\\b")
+	if lead_b:
+		i = 2
+	capture = False
+	group = False
+	if patt.startswith("(?:", i):
+		group = True
+		i += 3
+	elif patt.startswith("(", i) and not patt.startswith("(?", i):
+		group = capture = True
+		i += 1
+	alts = []
+	while True:
+		lit, i = scanliteral(patt, i)
+		if lit is None:
+			return None
+		alts.append(lit)
+		if i < n and patt[i] == "|":
+			i += 1
+			continue
+		break
+	if group:
+		if i >= n or patt[i] != ")":
+			return None
+		i += 1
+	elif len(alts) > 1 and lead_b:
+		# \ba|b is (\ba)|(b), not worth the trouble
+		return None
+	trail_b = patt.startswith("\\b", i)
+	if trail_b:
+		if len(alts) > 1 and not group:
+			return None
+		i += 2
+	if i != n:
+		return None
+	return lead_b, tuple(alts), trail_b, capture
+
+
+class LiteralMatch:
+
+	__slots__ = ("_start", "_end", "_text", "_ngroups")
+
+	def __init__(self, text:str, start:int, end:int, ngroups:int):
+		self._text = text
+		self._start = start
+		self._end = end
+		self._ngroups = ngroups
+
+	def __repr__(self):
+		return f"<sublregex.LiteralMatch span={self.span()} match={self.group()!r}>"
+
+	@property
+	def _begs(self):
+		# only participating groups here, see hl.group_matched()
+		return (self._start,) * self._ngroups
+
+	def group(self, n:int=0):
+		if n >= self._ngroups:
+			raise IndexError("no such group")
+		return self._text[self._start:self._end]
+
+	__getitem__ = group
+
+	def start(self, n:int=0):
+		if n >= self._ngroups:
+			raise IndexError("no such group")
+		return self._start
+
+	def end(self, n:int=0):
+		if n >= self._ngroups:
+			raise IndexError("no such group")
+		return self._end
+
+	def span(self, n:int=0):
+		return self.start(n), self.end(n)
+
+	@property
+	def string(self):
+		return self._text
+
+
+class FastPattern:
+
+	def __init__(self, pattern:str, lookahead:str, ngroups:int):
+		self._pattern = pattern
+		self.lookahead = lookahead
+		self.ngroups = ngroups
+		self.fallback = None
+
+	def __repr__(self):
+		return f"{__name__}.compile({self._pattern!r})"
+
+	def number_of_captures(self):
+		return self.ngroups - 1
+
+	def onig(self):
+		if self.fallback is None:
+			self.fallback = oniguruma.compile(self._pattern)
+		return self.fallback
+
+	def match(self, text:str, pos:int=0):
+		end = self.matchend(text, pos)
+		if end is None:
+			return self.onig().match(text, pos)
+		if self.lookahead is None:
+			return LiteralMatch(text, pos, end, self.ngroups) if end >= 0 else None
+		if (end >= 0) == (self.lookahead == "="):
+			return LiteralMatch(text, pos, pos, 1)
+		return None
+
+	def search(self, text:str, pos:int=0):
+		return self.onig().search(text, pos)
+
+
+class LiteralPattern(FastPattern):
+
+	def __init__(self, pattern:str, lookahead:str, lead_b:bool, alternatives:tuple, trail_b:bool, capture:bool):
+		super().__init__(pattern, lookahead, 2 if capture else 1)
+		self.lead_b = lead_b
+		self.alternatives = alternatives
+		self.trail_b = trail_b
+		# \b(?:word|word)\b: the match, if any, is the whole run of word characters at pos
+		self.words = frozenset(alternatives) if trail_b and all(map(lambda x:x and all(map(isasciiword, x)), alternatives)) else None
+
+	def matchend(self, text:str, pos:int):
+		# end of the match, -1 if there's none, None to let oniguruma decide
+		if self.lead_b:
+			b = wordboundary(text, pos)
+			if b is None:
+				return None
+			if not b:
+				return -1
+		words = self.words
+		if words is not None:
+			end = re_asciiword.match(text, pos).end()
+			if end < len(text) and not text[end].isascii():
+				return None
+			return end if text[pos:end] in words else -1
+		for alt in self.alternatives:
+			if text.startswith(alt, pos):
+				end = pos + len(alt)
+				if self.trail_b:
+					b = wordboundary(text, end)
+					if b is None:
+						return None
+					if not b:
+						continue
+				return end
+		return -1
+
+
+class ClassPattern(FastPattern):
+
+	def __init__(self, pattern:str, lookahead:str, atom:str):
+		super().__init__(pattern, lookahead, 1)
+		self.atom = atom
+		self.chars = asciiclass(atom)
+
+	def matchend(self, text:str, pos:int):
+		if pos >= len(text):
+			return -1
+		c = text[pos]
+		if not c.isascii():
+			return None
+		return pos + 1 if c in self.chars else -1
+
+
+def escape(text:str):
+	# text to match literally, e.g. to substitute a backreference
+	return "".join(map(lambda c:"\\" + c if c.isascii() and not c.isalnum() and c != "_" else c, text))
+
+
+ascii_classes = {}
+
+
+def asciiclass(atom:str):
+	# which ascii characters a single character class matches, as oniguruma sees it
+	chars = ascii_classes.get(atom, None)
+	if chars is None:
+		patt = oniguruma.compile(atom)
+		chars = ascii_classes[atom] = frozenset(filter(lambda c:patt.match(c), map(chr, range(128))))
+	return chars
+
+
+def scanclass(patt:str, i:int):
+	# end of the single character class atom at i, or -1
+	n = len(patt)
+	if i >= n:
+		return -1
+	c = patt[i]
+	if c == ".":
+		return i + 1
+	if c == "\\":
+		return i + 2 if patt[i + 1:i + 2] in class_escapes else -1
+	if c != "[":
+		return -1
+	j = i + 1
+	if patt.startswith("^", j):
+		j += 1
+	if patt.startswith("]", j):
+		return -1
+	depth = 1
+	while j < n:
+		c = patt[j]
+		if c == "\\":
+			j += 2
+			continue
+		if c == "[":
+			depth += 1
+		elif c == "]":
+			depth -= 1
+			if not depth:
+				return j + 1
+		j += 1
+	return -1
+
+
+class_escapes = frozenset(("s", "S", "w", "W", "d", "D", "h", "H"))
+
+
+def parsepattern(pattern:str):
+	lookahead = None
+	inner = pattern
+	if (pattern.startswith("(?=") or pattern.startswith("(?!")) and pattern.endswith(")"):
+		lookahead = pattern[2]
+		inner = pattern[3:-1]
+	literals = parseliterals(inner)
+	if literals is not None:
+		if lookahead and literals[3]:
+			# group spans inside lookaheads differ from the match span
+			return None
+		return LiteralPattern(pattern, lookahead, *literals)
+	if scanclass(inner, 0) == len(inner) > 0:
+		return ClassPattern(pattern, lookahead, inner)
+	return None
+
+
+def compile(pattern:str, intern:bool=True):
+	# syntaxes extending others (C++ of C, TypeScript of JavaScript...) and the syntaxes embedded in
+	# the same file share many patterns once their variables are expanded: compile each only once
+	if intern:
+		patt = interned.get(pattern, None)
+		if patt is None:
+			patt = interned.setdefault(pattern, compile(pattern, intern=False))
+		return patt
+	if fastpath:
+		fast = parsepattern(pattern)
+		if fast is not None:
+			return fast
+	return oniguruma.compile(pattern)
+
+
+
+re_flags = re.compile(r"\(\?([imx]*)(?:-([imx]*))?([:)])")
+re_interval = re.compile(r"\{(\d*)(,?)(\d*)\}")
+re_hexescape = re.compile(r"\\(?:x\{([0-9A-Fa-f]+)\}|x([0-9A-Fa-f]{1,2})|u([0-9A-Fa-f]{4}))")
+re_propescape = re.compile(r"\\[pP]\{\^?[A-Za-z0-9_ ]+\}")
+zero_width_escapes = frozenset(("b", "B", "A", "G"))
+
+
+class Unanalyzable(Exception):
+	pass
+
+
+def firstchars(pattern:str):
+	# conservative set of characters text[pos] can be for pattern to match at pos < len(text),
+	# as (ascii chars, whether non-ascii chars can), None if it can't be told
+	try:
+		chars, nonascii, nullable, i = FirstChars(pattern).alternation(0)
+	except (Unanalyzable, oniguruma.OnigError):
+		return None
+	if nullable or i != len(pattern):
+		return None
+	return frozenset(chars), nonascii
+
+
+class FirstChars:
+
+	def __init__(self, pattern:str):
+		self.pattern = pattern
+		self.flags = ""
+
+	def setflags(self, on:str, off:str):
+		self.flags = "".join(sorted(set(self.flags + on) - set(off)))
+
+	def alternation(self, i:int):
+		chars = set()
+		nonascii = False
+		nullable = False
+		while True:
+			achars, anonascii, anullable, i = self.sequence(i)
+			chars |= achars
+			nonascii = nonascii or anonascii
+			nullable = nullable or anullable
+			if i < len(self.pattern) and self.pattern[i] == "|":
+				i += 1
+				continue
+			return chars, nonascii, nullable, i
+
+	def sequence(self, i:int):
+		p = self.pattern
+		n = len(p)
+		chars = set()
+		nonascii = False
+		nullable = True
+		while True:
+			i = self.skipspace(i)
+			if i >= n or p[i] in "|)":
+				return chars, nonascii, nullable, i
+			flags = re_flags.match(p, i)
+			if flags and flags.group(3) == ")":
+				# (?i) and friends apply to the rest of the enclosing group
+				self.setflags(flags.group(1), flags.group(2) or "")
+				i = flags.end()
+				continue
+			achars, anonascii, anullable, i = self.atom(i)
+			while True:
+				i = self.skipspace(i)
+				interval = re_interval.match(p, i)
+				if i < n and p[i] in "*?+":
+					anullable = anullable or p[i] != "+"
+					i += 1
+				elif interval and interval.group(1, 3) != ("", ""):
+					anullable = anullable or not int(interval.group(1) or "0")
+					i = interval.end()
+				else:
+					break
+			if nullable:
+				chars |= achars
+				nonascii = nonascii or anonascii
+				nullable = anullable
+
+	def skipspace(self, i:int):
+		if "x" not in self.flags:
+			return i
+		p = self.pattern
+		n = len(p)
+		while i < n:
+			if p[i].isspace():
+				i += 1
+			elif p[i] == "#":
+				i = p.find("\n", i)
+				if i < 0:
+					return n
+			else:
+				break
+		return i
+
+	def literal(self, c:str):
+		if not c.isascii():
+			return set(), True
+		if "i" in self.flags and c.isalpha():
+			# case folding also reaches a few non-ascii characters, e.g. KELVIN SIGN for k
+			return {c.lower(), c.upper()}, True
+		return {c}, False
+
+	def charclass(self, atom:str):
+		prefix = f"(?{self.flags})" if self.flags else ""
+		return set(asciiclass(prefix + atom)), True
+
+	def group(self, i:int):
+		flags = self.flags
+		chars, nonascii, nullable, i = self.alternation(i)
+		self.flags = flags
+		if i >= len(self.pattern) or self.pattern[i] != ")":
+			raise Unanalyzable()
+		return chars, nonascii, nullable, i + 1
+
+	def atom(self, i:int):
+		p = self.pattern
+		c = p[i]
+		if c == "(":
+			if not p.startswith("?", i + 1):
+				return self.group(i + 1)
+			if p.startswith("(?:", i) or p.startswith("(?>", i) or p.startswith("(?=", i):
+				return self.group(i + 3)
+			if p.startswith("(?!", i):
+				return (set(), False, True) + self.group(i + 3)[3:]
+			if p.startswith("(?<=", i) or p.startswith("(?<!", i):
+				return (set(), False, True) + self.group(i + 4)[3:]
+			if p.startswith("(?<", i) or p.startswith("(?'", i):
+				end = p.find(">" if p[i + 2] == "<" else "'", i + 3)
+				if end < 0:
+					raise Unanalyzable()
+				return self.group(end + 1)
+			if p.startswith("(?#", i):
+				end = p.find(")", i)
+				if end < 0:
+					raise Unanalyzable()
+				return set(), False, True, end + 1
+			flags = re_flags.match(p, i)
+			if flags and flags.group(3) == ":":
+				outer = self.flags
+				self.setflags(flags.group(1), flags.group(2) or "")
+				result = self.group(flags.end())
+				self.flags = outer
+				return result
+			# absent operator, conditionals
+			raise Unanalyzable()
+		if c == "[" or c == ".":
+			end = scanclass(p, i)
+			if end < 0:
+				raise Unanalyzable()
+			return self.charclass(p[i:end]) + (False, end)
+		if c == "^":
+			return set(), False, True, i + 1
+		if c == "$":
+			# end of line, which is a "\n" unless pos is at the end of text
+			return {"\n"}, False, False, i + 1
+		if c == "\\":
+			d = p[i + 1:i + 2]
+			if d in class_escapes:
+				return self.charclass(p[i:i + 2]) + (False, i + 2)
+			if d in zero_width_escapes:
+				return set(), False, True, i + 2
+			if d == "Z":
+				return {"\n"}, False, False, i + 2
+			if d == "z":
+				return set(), False, False, i + 2
+			if d in literal_ctrl_escapes:
+				return self.literal(literal_ctrl_escapes[d]) + (False, i + 2)
+			if d and d.isascii() and not d.isalnum():
+				return self.literal(d) + (False, i + 2)
+			m = re_hexescape.match(p, i)
+			if m:
+				return self.literal(chr(int(m.group(1) or m.group(2) or m.group(3), 16))) + (False, m.end())
+			m = re_propescape.match(p, i)
+			if m:
+				return self.charclass(m.group()) + (False, m.end())
+			# backreferences, subexpression calls, octal escapes, \R, \X, ...
+			raise Unanalyzable()
+		if c in "*+?":
+			raise Unanalyzable()
+		return self.literal(c) + (False, i + 1)
@@ -1,4 +1,6 @@
 import os
+import re
+import threading
 import yaml
 from itertools import chain
 
@@ -32,6 +34,11 @@ all_syntaxes_paths = list(
 	)
 )
 LOAD_SYNTAX_CACHE = {}
+SCOPE_PATHS = None
+scope_paths_lock = threading.Lock()
+re_syntax_scope = re.compile(r"^scope:\s*(\S+)")
+# parsesyntax() completes loaded syntaxes in place
+parse_lock = threading.RLock()
 __hl_parsed_key = "__hl_parsed"
 
 
@@ -45,7 +52,8 @@ def loadsyntax(path, cache=True):
 	with open(path, "rb") as f:
 		syntax = yaml.load(f, Loader=yaml.SafeLoader)
 		if cache:
-			LOAD_SYNTAX_CACHE[path] = syntax
+			# whoever loaded it first, every caller gets the same dict
+			syntax = LOAD_SYNTAX_CACHE.setdefault(path, syntax)
 		return syntax
 
 
@@ -69,6 +77,42 @@ def loadsyntax_until(path, marker_regexes, cache=True):
 	return None
 
 
+def syntaxpathsbyscope():
+	# scope -> path of every syntax, from their top level "scope:" line
+	global SCOPE_PATHS
+	with scope_paths_lock:
+		if SCOPE_PATHS is None:
+			paths = {}
+			for path in all_syntaxes_paths:
+				with open(path, "r", encoding="latin1") as f:
+					for line in f:
+						m = re_syntax_scope.match(line)
+						if m:
+							paths.setdefault(m.group(1).strip("'\""), path)
+							break
+			SCOPE_PATHS = paths
+		return SCOPE_PATHS
+
+
+def syntaxreferences(syntax:dict):
+	# every scope: and packages/ reference of the contexts of syntax
+	refs = set()
+	def walk(value):
+		if isinstance(value, str):
+			if value.startswith("scope:") or value.startswith("packages/"):
+				refs.add(value)
+		elif isinstance(value, list):
+			for item in value:
+				walk(item)
+		elif isinstance(value, dict):
+			for key in ("include", "push", "set", "embed", "branch", "with_prototype"):
+				if key in value:
+					walk(value[key])
+	for ctx in syntax["contexts"].values():
+		walk(ctx)
+	return refs
+
+
 def loadsyntaxesmp(paths, syntaxloader=loadsyntax):
 	from multiprocessing.pool import ThreadPool as MPPool
 	def threadloadsyntax(path):
@@ -78,48 +122,47 @@ def loadsyntaxesmp(paths, syntaxloader=loadsyntax):
 
 
 def parsesyntax(syntax: dict, postlazyloadsyntax = lambda x: x):
-	if __hl_parsed_key in syntax:
-		return syntax
-	def _syntax_merge_vars(*s):
-		return {k: v for k, v in chain(*map(dict.items, map(lambda x:x.get("variables", None) or {}, s)))}
-	def _syntax_merge_contexts(*s):
-		result = {}
-		for synt in s:
-			ctx = synt["contexts"]
-			for ctxname in ctx:
-				if ctxname not in result:
-					result[ctxname] = ctx[ctxname]
-				elif ctx_findprop(ctx[ctxname], "meta_prepend", False):
-					result[ctxname] = ctx[ctxname] + result[ctxname]
-				elif ctx_findprop(ctx[ctxname], "meta_append", False):
-					result[ctxname] = result[ctxname] + ctx[ctxname]
-				else:
-					result[ctxname] = ctx[ctxname] + result[ctxname]
-		return result
-	parent_syntaxes = syntax.get("extends", None)
-	if parent_syntaxes:
-		if isinstance(parent_syntaxes, str):
-			parent_syntaxes = [parent_syntaxes]
-		parent_syntaxes = list(
-			map(
-				lambda x: parsesyntax(
-					loadsyntax(
-						os.path.abspath(
-							os.path.join(
-								syntax_dir_path,
-								os.path.basename(x)
+	with parse_lock:
+		if __hl_parsed_key in syntax:
+			return syntax
+		def _syntax_merge_vars(*s):
+			return {k: v for k, v in chain(*map(dict.items, map(lambda x:x.get("variables", None) or {}, s)))}
+		def _syntax_merge_contexts(*s):
+			result = {}
+			for synt in s:
+				ctx = synt["contexts"]
+				for ctxname in ctx:
+					if ctxname not in result:
+						result[ctxname] = ctx[ctxname]
+					elif ctx_findprop(ctx[ctxname], "meta_prepend", False):
+						result[ctxname] = ctx[ctxname] + result[ctxname]
+					elif ctx_findprop(ctx[ctxname], "meta_append", False):
+						result[ctxname] = result[ctxname] + ctx[ctxname]
+					else:
+						result[ctxname] = ctx[ctxname] + result[ctxname]
+			return result
+		parent_syntaxes = syntax.get("extends", None)
+		if parent_syntaxes:
+			if isinstance(parent_syntaxes, str):
+				parent_syntaxes = [parent_syntaxes]
+			parent_syntaxes = list(
+				map(
+					lambda x: parsesyntax(
+						loadsyntax(
+							os.path.abspath(
+								os.path.join(
+									syntax_dir_path,
+									os.path.basename(x)
+								)
 							)
-						)
+						),
+						postlazyloadsyntax=postlazyloadsyntax
 					),
-					postlazyloadsyntax=postlazyloadsyntax
-				),
-				parent_syntaxes
+					parent_syntaxes
+				)
 			)
-		)
-		syntax["variables"] = _syntax_merge_vars(*parent_syntaxes, syntax)
-		syntax["contexts"] = _syntax_merge_contexts(*parent_syntaxes, syntax)
-	syntax[__hl_parsed_key] = True
-	postlazyloadsyntax(syntax)
-	return syntax
-
-	
\ No newline at end of file
+			syntax["variables"] = _syntax_merge_vars(*parent_syntaxes, syntax)
+			syntax["contexts"] = _syntax_merge_contexts(*parent_syntaxes, syntax)
+		syntax[__hl_parsed_key] = True
+		postlazyloadsyntax(syntax)
+		return syntax